@@ -0,0 +1,178 @@
+"""Plays many curling.py AI games at once with numpy, for balance studies.
+
+Each game is a row of 25 cell codes (player slot * 16 + value, slot 0 for blanks, the joker and empty cells)
+and a 13 bit hand mask per player. Moves are applied to every game at once as gathers through precomputed
+index tables, and the scores are weighted sums over the scoring cells. Only the AIs curling.main runs are
+covered: the random AI ('r', 'r1', 'r2') and the greedy one_set_ai ('')."""
+import numpy as np
+
+import curling
+from curling2 import edge_paths
+
+# Both AIs always play their highest card, the first of equal values in hand order (K, Q, J, A, 2 ... 10).
+# Hand bits are in that playing order so the card to play is the lowest set bit.
+PLAY_VALUES = np.array([10, 10, 10, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1])
+LOWEST_BIT = np.array([(m & -m).bit_length() - 1 for m in range(1 << 13)])
+FULL_HAND = (1 << 13) - 1
+
+BOUNDS = {'r': (1, 5), 'r1': (1, 3), 'r2': (2, 4)}  # rows/columns random_ai_turn picks from
+
+
+class Tables:
+    """Board layout and move tables for a board size, derived from curling.Board"""
+    def __init__(self, size=5):
+        board = curling.Board(size)
+        self.size = size
+        n = size * size
+        self.n = n
+        self.empty = np.array([not board._cards[i // size][i % size] for i in range(n)])
+        self.scoring = np.array([x * size + y for s in sorted(board.scoring_pos) for x, y in board.scoring_pos[s]])
+        self.weights = np.array([s for s in sorted(board.scoring_pos) for _ in board.scoring_pos[s]])
+
+        # Edge moves in one_set_ai's order: top, bottom, left, right. Row m of perm is the gather from the
+        # 25 cells plus the played card (index n) that gives the board after move m
+        self.edges = [(0, i) for i in range(1, size + 1)] + [(size + 1, i) for i in range(1, size + 1)] + \
+                     [(i, 0) for i in range(1, size + 1)] + [(i, size + 1) for i in range(1, size + 1)]
+        paths = edge_paths(size)
+        self.perm = np.tile(np.arange(n), (len(self.edges), 1))
+        for m, move in enumerate(self.edges):
+            path = paths[move]
+            self.perm[m, path[0]] = n
+            for k in range(1, len(path)):
+                self.perm[m, path[k]] = path[k - 1]
+        # inserting into cell c is the gather with only c taken from the card
+        self.insert_perm = np.tile(np.arange(n), (n, 1))
+        self.insert_perm[np.arange(n), np.arange(n)] = n
+
+        # the same gathers restricted to the scoring cells, for scoring every candidate move without playing it
+        self.edge_scoring = self.perm[:, self.scoring]
+        self.insert_scoring = self.insert_perm[:, self.scoring]
+
+        self.rows = np.arange(n) // size + 1
+        self.cols = np.arange(n) % size + 1
+
+
+def card_values(n_players):
+    # card_values(n)[p, code] is what the card with that code is worth to player p on a scoring cell
+    codes = np.arange(16 * (n_players + 1))
+    return ((codes >> 4) == np.arange(1, n_players + 1)[:, None]) * (codes & 15)
+
+
+def points(tables, cells, values):
+    """Weighted sum of values[code] over the scoring cells. cells is (..., 25), or already restricted to the
+    scoring cells (..., 8)"""
+    if cells.shape[-1] == tables.n:
+        cells = cells[..., tables.scoring]
+    return (values[cells] * tables.weights).sum(axis=-1)
+
+
+def uniform_choice(rng, mask):
+    """Index of a uniformly random True in each row of mask (0 where a row has none)"""
+    keys = rng.random(mask.shape)
+    keys[~mask] = -1
+    return keys.argmax(axis=1)
+
+
+def weighted_choice(rng, weights):
+    """Index drawn from each row of non-negative weights in proportion to them"""
+    cumulative = weights.cumsum(axis=1)
+    draw = rng.random(len(weights)) * cumulative[:, -1]
+    return (cumulative > draw[:, None]).argmax(axis=1)
+
+
+def random_insert(rng, tables, empty, gm):
+    # random_ai_turn in the setup phase
+    lo, hi = BOUNDS[gm]
+    choice = uniform_choice(rng, empty)
+    in_rows = (tables.rows >= lo) & (tables.rows <= hi)
+    in_cols = (tables.cols >= lo) & (tables.cols <= hi)
+    e1 = empty & in_rows & in_cols
+    er = empty & in_rows
+    ec = empty & in_cols
+    has_er = er.any(axis=1)
+    has_ec = ec.any(axis=1)
+    pick_rows = rng.random(len(empty)) < 0.5
+    use_er = has_er & (pick_rows | ~has_ec)
+    use_ec = ~use_er & has_ec
+    choice = np.where(use_er, uniform_choice(rng, er), choice)
+    choice = np.where(use_ec, uniform_choice(rng, ec), choice)
+    return np.where(e1.any(axis=1), uniform_choice(rng, e1), choice)
+
+
+def random_edge(rng, tables, k, gm):
+    # random_ai_turn once the board is full: any side, then a row or column within the bounds
+    lo, hi = BOUNDS[gm]
+    side = rng.integers(0, 4, k)
+    return side * tables.size + rng.integers(lo, hi + 1, k) - 1
+
+
+def greedy(rng, tables, ext, candidates, valid, values):
+    # one_set_ai: 2 * own score - everyone's score after each candidate, values being the per card version of that.
+    # Ties are broken at random, and like one_set_ai the first candidate stays in the draw (twice if it scores 0)
+    # unless something scores above 0
+    value = points(tables, np.take(ext, candidates, axis=1), values)
+    first = valid.argmax(axis=1)
+    value = np.where(valid, value, np.iinfo(value.dtype).min)
+    top = value.max(axis=1)
+    weights = np.where(top[:, None] > 0, value == top[:, None], value == 0).astype(np.int64)
+    weights[np.arange(len(value)), first] += (top <= 0)
+    weights[~valid] = 0
+    return weighted_choice(rng, weights)
+
+
+def simulate(games, gm=('', '', ''), seed=None, size=5, batch=20000):
+    """Final scores of that many AI-only games of curling.main((1, 1, 1), gm), as a (games, players) array"""
+    rng = np.random.default_rng(seed)
+    tables = Tables(size)
+    out = [_simulate_batch(rng, tables, min(batch, games - start), gm) for start in range(0, games, batch)]
+    return np.concatenate(out) if out else np.zeros((0, len(gm)), dtype=int)
+
+
+def _simulate_batch(rng, tables, k, gm):
+    n_players = len(gm)
+    n = tables.n
+    cells = np.zeros((k, n), dtype=np.int32)
+    empty = np.tile(tables.empty, (k, 1))
+    hands = np.full((k, n_players), FULL_HAND)
+    totals = np.zeros((k, n_players), dtype=np.int64)
+    games = np.arange(k)
+    values = card_values(n_players)
+    greedy_values = 2 * values - values.sum(axis=0)
+
+    for t in range(n_players * len(PLAY_VALUES)):
+        p = t % n_players
+        bit = LOWEST_BIT[hands[:, p]]
+        hands[:, p] &= ~(1 << bit)
+        card = (p + 1) << 4 | PLAY_VALUES[bit]
+        ext = np.concatenate([cells, card[:, None]], axis=1)
+
+        if empty.any():
+            if gm[p]:
+                move = random_insert(rng, tables, empty, gm[p])
+            else:
+                move = greedy(rng, tables, ext, tables.insert_scoring, empty, greedy_values[p])
+            cells[games, move] = card
+            empty[games, move] = False
+        else:
+            if gm[p]:
+                move = random_edge(rng, tables, k, gm[p])
+            else:
+                valid = np.ones((k, len(tables.edges)), dtype=bool)
+                move = greedy(rng, tables, ext, tables.edge_scoring, valid, greedy_values[p])
+            cells = np.take_along_axis(ext, tables.perm[move], axis=1)
+
+        # the next player picks up what's on the board for them
+        nxt = (p + 1) % n_players
+        totals[:, nxt] += points(tables, cells, values[nxt])
+
+    return totals + np.stack([points(tables, cells, v) for v in values], axis=1)
+
+
+def summary(scores):
+    """Same figures as selfplay.Results.summary, from a (games, players) array"""
+    top = scores.max(axis=1)
+    return {'games': len(scores),
+            'wins': (scores == top[:, None]).sum(axis=0).tolist(),
+            'mean_scores': scores.mean(axis=0).tolist(),
+            'margins': (scores - np.roll(scores, -1, axis=1)).mean(axis=0).tolist(),
+            'mean_winning_score': float(top.mean())}
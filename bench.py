@@ -0,0 +1,307 @@
+"""Benchmarks for the two game engines and the AIs.
+
+Every benchmark seeds random before it sets up and before each run, so two runs do the same work and only the times
+differ. A run is the best of a few repeats, reported per op (an op being one board update and its undo, one AI move,
+one game and so on). Results go to a JSON file along with the Python version and machine, and two result files can
+be compared to check a change for regressions.
+
+    python bench.py [quick] [file]      run and write the results to file, bench.json by default
+    python bench.py compare old new     each benchmark's speedup in new over old"""
+import functools
+import json
+import platform
+import random
+import sys
+import time
+
+import curling
+import curling2
+import endgame
+from cards import Card
+from movegen import move_table
+
+SEED = 1
+PLAYERS = [('Matt', chr(9829)), ('F. Rob', chr(9830)), ('Rob H.', chr(9827))]
+
+BENCHMARKS = {}  # name -> (setup, in the quick run)
+
+
+def benchmark(name, quick=True):
+    """Register setup() under name. setup returns (run, ops): run() does ops ops and is what gets timed"""
+    def register(setup):
+        BENCHMARKS[name] = (setup, quick)
+        return setup
+    return register
+
+
+def full_board():
+    # a main phase board of random cards from all three suits
+    board = curling2.Board(empty=[])
+    cards = [Card(name, suit) for _, suit in PLAYERS for name in 'KQJA234567890']
+    cells = [random.choice(cards).id for _ in range(board.size * board.size)]
+    cells[board.joker_pos * board.size + board.joker_pos] = board.joker.id
+    board.set_cells(cells)
+    return board
+
+
+def position(plies, player=curling2.AIPlayer):
+    # a game after plies random AI moves, setup takes the first 12
+    players = [player(n, s) for n, s in PLAYERS]
+    game = curling2.Game(curling2.StartGameState(curling2.Board(), players), autostart=False, verbose=False)
+    for _ in range(plies):
+        game.turn()
+    return game
+
+
+def update_pairs(board, plies, n=2000):
+    def run():
+        for _ in range(n):
+            for ply in plies:
+                discarded, error = board.update(ply)
+                board.update(ply, True, discarded)
+    return run, n * len(plies)
+
+
+@benchmark('board.update insert')
+def bench_insert():
+    board = curling2.Board()
+    card = Card('K', PLAYERS[0][1])
+    return update_pairs(board, [curling2.Ply(card, r, c) for r, c in board.get_empty()])
+
+
+@benchmark('board.update row')
+def bench_row():
+    board = full_board()
+    card = Card('7', PLAYERS[0][1])
+    return update_pairs(board, [curling2.Ply(card, r, c) for r in (1, 2, 4, 5) for c in (0, board.size + 1)])
+
+
+@benchmark('board.update column')
+def bench_column():
+    board = full_board()
+    card = Card('7', PLAYERS[0][1])
+    return update_pairs(board, [curling2.Ply(card, r, c) for c in (1, 2, 4, 5) for r in (0, board.size + 1)])
+
+
+@benchmark('board.update joker row/column')
+def bench_joker():
+    board = full_board()
+    card = Card('7', PLAYERS[0][1])
+    middle = board.joker_pos + 1
+    return update_pairs(board, [curling2.Ply(card, middle, 0), curling2.Ply(card, middle, board.size + 1),
+                                curling2.Ply(card, 0, middle), curling2.Ply(card, board.size + 1, middle)])
+
+
+@benchmark('board.update undo without history')
+def bench_undo():
+    # undoing a move made before the board was loaded shifts the line back rather than copying the cells back
+    board = full_board()
+    ply = curling2.Ply(Card('7', PLAYERS[0][1]), 2, 0)
+    n = 10000
+
+    def run():
+        for _ in range(n):
+            discarded, error = board.update(ply)
+            board._changes.clear()
+            board.update(ply, True, discarded)
+    return run, n
+
+
+@benchmark('board.score')
+def bench_score():
+    board = full_board()
+    players = [curling2.Player(n, s) for n, s in PLAYERS]
+    n = 20000
+
+    def run():
+        for _ in range(n):
+            for player in players:
+                board.score(player)
+    return run, n * len(players)
+
+
+@benchmark('board.get_empty')
+def bench_get_empty():
+    board = curling2.Board()
+    n = 20000
+
+    def run():
+        for _ in range(n):
+            board.get_empty()
+    return run, n
+
+
+@benchmark('game.make_move/unmake_move')
+def bench_make_unmake():
+    game = position(15)
+    table = move_table(game.board.size)
+    plies = [curling2.Ply(card, *table.targets[t]) for card in game.players[game.p_turn].hand for t in table.edges]
+    n = 200
+
+    def run():
+        for _ in range(n):
+            for ply in plies:
+                game.make_move(ply)
+                game.unmake_move()
+    return run, n * len(plies)
+
+
+@benchmark('GameState.fork')
+def bench_fork():
+    state = position(15).get_game_state()
+    n = 5000
+
+    def run():
+        for _ in range(n):
+            state.fork()
+    return run, n
+
+
+@benchmark('AITreeSearch.child_values per child')
+def bench_child_values():
+    game = position(15)
+    ai = curling2.AITreeSearch(*PLAYERS[game.p_turn])
+    ai.new_search(game)
+    moves = ai.movegen.all_moves(game)
+    n = 100
+
+    def run():
+        for _ in range(n):
+            ai.child_values(game, moves)
+    return run, n * len(moves)
+
+
+def tree_move(depth, plies, full_hand=False):
+    game = position(plies)
+    ai = curling2.AITreeSearch(*PLAYERS[game.p_turn])
+    ai.depth = depth
+    ai.movegen.full_hand = full_hand
+    ai.hand = game.players[game.p_turn].hand
+    ai.score = game.players[game.p_turn].score
+    game.players[game.p_turn] = ai
+    state = game.get_game_state()
+
+    def run():
+        ai.tt.clear()
+        ai.make_move(state)
+    return run, 1
+
+
+for depth in (1, 2):
+    benchmark('AITreeSearch.make_move depth {} setup'.format(depth))(functools.partial(tree_move, depth, 4))
+    benchmark('AITreeSearch.make_move depth {}'.format(depth))(functools.partial(tree_move, depth, 15))
+benchmark('AITreeSearch.make_move depth 3 setup', quick=False)(functools.partial(tree_move, 3, 4))
+benchmark('AITreeSearch.make_move depth 1 full hand')(functools.partial(tree_move, 1, 15, True))
+
+
+@benchmark('AIMCTSPlayer.make_move 200 playouts')
+def bench_mcts():
+    game = position(15)
+    ai = curling2.AIMCTSPlayer(*PLAYERS[game.p_turn])
+    ai.iterations = 200
+    ai.hand = game.players[game.p_turn].hand
+    ai.score = game.players[game.p_turn].score
+    game.players[game.p_turn] = ai
+    state = game.get_game_state()
+
+    def run():
+        ai.tree = None
+        ai.make_move(state)
+    return run, 1
+
+
+@benchmark('EndgameSolver.solve 3 plies')
+def bench_endgame():
+    game = position(36)
+
+    def run():
+        solver = endgame.EndgameSolver()
+        solver.solve(game)
+    return run, 1
+
+
+def curling_game(gm):
+    # one curling.py game of AI turns, each op being a turn
+    def run():
+        curling.main((1, 1, 1), gm, fname='')
+    return run, 39
+
+
+@benchmark('curling one_set_ai turn')
+def bench_one_set_ai():
+    return curling_game(('', '', ''))
+
+
+@benchmark('curling random_ai_turn turn')
+def bench_random_ai_turn():
+    return curling_game(('r', 'r', 'r'))
+
+
+@benchmark('curling2 game, AIPlayers')
+def bench_ai_game():
+    def run():
+        for _ in range(20):
+            position(39)
+    return run, 20
+
+
+@benchmark('curling2 game, depth 1 AITreeSearch', quick=False)
+def bench_tree_game():
+    def run():
+        game = position(0, curling2.AITreeSearch)
+        for player in game.players:
+            player.depth = 1
+        game.gameloop()
+    return run, 1
+
+
+def run_benchmarks(names=None, quick=False, repeats=3):
+    """{name: result} for the named benchmarks, or all of them (only the quick ones with quick set)"""
+    results = {}
+    for name, (setup, in_quick) in BENCHMARKS.items():
+        if names is not None and name not in names or quick and not in_quick:
+            continue
+        random.seed(SEED)
+        run, ops = setup()
+        best = float('inf')
+        for _ in range(1 if quick else repeats):
+            random.seed(SEED)
+            start = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - start)
+        results[name] = {'ops': ops, 'seconds': best, 'ops_per_s': ops / best, 'us_per_op': best / ops * 1e6}
+    return results
+
+
+def save(results, fname):
+    with open(fname, 'w') as f:
+        json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'time': time.time(),
+                   'results': results}, f, indent=1, sort_keys=True)
+
+
+def compare(old, new):
+    """{name: speedup} for the benchmarks in both result files, above 1 where new is faster"""
+    with open(old) as f:
+        old = json.load(f)['results']
+    with open(new) as f:
+        new = json.load(f)['results']
+    return {name: old[name]['us_per_op'] / new[name]['us_per_op'] for name in old if name in new}
+
+
+def report(results):
+    for name, r in results.items():
+        print('{:<44}{:>14.2f} us{:>14.1f} /s'.format(name, r['us_per_op'], r['ops_per_s']))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == 'compare':
+        for name, speedup in compare(args[1], args[2]).items():
+            print('{:<44}{:>8.2f}x'.format(name, speedup))
+    else:
+        quick = bool(args) and args[0] == 'quick'
+        if quick:
+            args = args[1:]
+        results = run_benchmarks(quick=quick)
+        report(results)
+        save(results, args[0] if args else 'bench.json')
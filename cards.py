@@ -0,0 +1,91 @@
+"""The cards shared by curling.py and curling2.py.
+
+Cards are interned and immutable: Card(name, suit) always returns the same object for a card, so cards compare by
+identity and cost nothing to copy. Each has a small int id with the suit index in the high bits and the rank in the
+low four, which is how boards store them (0 being an empty cell), and a hand can be held as a bitmask of ranks."""
+
+RANKS = {'A': 1, '2': 2, '3': 3, '4': 4, '5': 5, '6': 6, '7': 7, '8': 8, '9': 9, '0': 10, 'J': 11, 'Q': 12, 'K': 13,
+         '*': 14, 'Jkr': 15}
+RANK_NAMES = {r: n for n, r in RANKS.items()}
+VALUES = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 10, 10, 10, 0, 0]  # indexed by rank
+SUITS = ['', '*', chr(9829), chr(9830), chr(9827), chr(9824)]
+SUIT_IDS = {s: i for i, s in enumerate(SUITS)}
+
+
+def suit_id(suit):
+    if suit not in SUIT_IDS:
+        SUIT_IDS[suit] = len(SUITS)
+        SUITS.append(suit)
+    return SUIT_IDS[suit]
+
+
+def card_name(name):
+    name = str(name)
+    if name == '10':
+        name = '0'  # For spacing
+    return name
+
+
+class Card:
+    __slots__ = ('name', 'value', 'suit', 'id')
+    _interned = {}
+
+    def __new__(cls, name, suit):
+        name = card_name(name)
+        card = Card._interned.get((name, suit))
+        if card is None:
+            if name == 'Jkr':
+                cls = Joker
+            card = object.__new__(cls)
+            object.__setattr__(card, 'name', name)
+            object.__setattr__(card, 'value', VALUES[RANKS[name]])
+            object.__setattr__(card, 'suit', suit)
+            object.__setattr__(card, 'id', suit_id(suit) << 4 | RANKS[name])
+            Card._interned[name, suit] = card
+        return card
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Cards are immutable')
+
+    def __reduce__(self):
+        return Card, (self.name, self.suit)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return '{} {}'.format(self.name, self.suit)
+
+
+class Joker(Card):
+    __slots__ = ()
+
+    def __new__(cls):
+        return Card.__new__(cls, 'Jkr', '')
+
+    def __reduce__(self):
+        return Joker, ()
+
+    def __repr__(self):
+        return self.name
+
+
+def card_from_id(cid):
+    return Card(RANK_NAMES[cid & 15], SUITS[cid >> 4])
+
+
+def card_rank(card):
+    """Rank of a Card or card name, None for anything else"""
+    if isinstance(card, Card):
+        return card.id & 15
+    return RANKS.get(card_name(card))
+
+
+def hand_mask(cards):
+    mask = 0
+    for card in cards:
+        mask |= 1 << (card.id & 15)
+    return mask
@@ -1,43 +1,19 @@
+import atexit
+import collections
+import functools
+import io
+import os
 import pickle
 import random
+import time
 
+from cards import Card, Joker, RANK_NAMES, card_rank, hand_mask
+from movegen import bounded_cells
+from selfplay import play_games
 
-PRINT = False
-
-
-class Card:
-    def __init__(self, name, suit):
-        self.name = str(name)
-        if self.name == '10':
-            self.name = '0'  # For spacing
-        if name in ['*', 'Jkr']:
-            self.value = 0
-        elif name in ['J', 'Q', 'K']:
-            self.value = 10
-        elif name == 'A':
-            self.value = 1
-        else:
-            self.value = int(name)
-        self.suit = suit
-        self.played = False
-        self.discarded = False
-
-    # def __eq__(self, other):
-    #     return self.name == other.name and self.suit == other.suit and self.value == other.value and \
-    # self.played == other.played and self.discarded == other.discarded
 
-    def __repr__(self):
-        return '{} {}'.format(self.name, self.suit)
-
-
-class Joker(Card):
-    def __init__(self):
-        super().__init__('Jkr', '')
-        self.played = True
-        self.discarded = False
-
-    def __repr__(self):
-        return self.name
+PRINT = False
+BOOK = None  # an openings.OpeningBook for one_set_ai to play the setup phase from
 
 
 class Board:
@@ -58,6 +34,50 @@ class Board:
                                 (self.joker_pos + 1, self.joker_pos - 1), (self.joker_pos + 1, self.joker_pos + 1)],
                             2: [(self.joker_pos - 1, self.joker_pos), (self.joker_pos, self.joker_pos - 1),
                                 (self.joker_pos + 1, self.joker_pos), (self.joker_pos, self.joker_pos + 1)]}
+        self._tables()
+
+    def _tables(self):
+        # The lookups and running totals kept alongside the cards. Saves from before they were added are loaded
+        # without them, and rebuild them here
+        self._weights = {pos: s for s, l in self.scoring_pos.items() for pos in l}
+        self._totals = {}  # suit -> points currently on the scoring cells
+        self._add_totals(self._weights, 1)
+        # For each edge move, the scoring cells it changes and the cell each one takes its card from (None for the
+        # card played), so a move can be scored without playing it
+        self._effects = {}
+        size = self.size
+        for i in range(1, size + 1):
+            for move in [(0, i), (size + 1, i), (i, 0), (i, size + 1)]:
+                path = self._path(*move)
+                self._effects[move] = [(pos, path[k - 1] if k else None) for k, pos in enumerate(path)
+                                       if pos in self._weights]
+
+    def _path(self, row, column):
+        # Cells an edge move shifts, from where the card goes in to the one that drops off, skipping the joker
+        if column == 0:
+            path = [(row - 1, y) for y in range(self.size)]
+        elif column == self.size + 1:
+            path = [(row - 1, y) for y in range(self.size - 1, -1, -1)]
+        elif row == 0:
+            path = [(x, column - 1) for x in range(self.size)]
+        else:
+            path = [(x, column - 1) for x in range(self.size - 1, -1, -1)]
+        if (self.joker_pos, self.joker_pos) in path:
+            path.remove((self.joker_pos, self.joker_pos))
+        return path
+
+    def _add_totals(self, cells, sign):
+        # Add (or with sign -1 remove) the scoring contribution of the given cells to the running totals
+        for x, y in cells:
+            card = self._cards[x][y]
+            if card and (x, y) in self._weights:
+                self._totals[card.suit] = self._totals.get(card.suit, 0) + sign * self._weights[x, y] * card.value
+
+    def _line(self, row, column):
+        # Scoring cells in the row or column shifted by an edge move
+        if 0 < row <= self.size:
+            return [(x, y) for x, y in self._weights if x == row - 1]
+        return [(x, y) for x, y in self._weights if y == column - 1]
 
     @property
     def cards(self):
@@ -78,12 +98,31 @@ class Board:
             return []
 
     def score(self, suit):
-        out = 0
-        if not self._final:
-            for s, l in self.scoring_pos.items():
-                for x, y in l:
-                    if self._cards[x][y] and self._cards[x][y].suit == suit:
-                        out += s * self._cards[x][y].value
+        if self._final:
+            return 0
+        return self._totals.get(suit, 0)
+
+    def test_moves(self, card, moves, suits):
+        """Scores for each suit after playing card at each (row, column) in moves, without playing it. Only the
+        scoring cells a move changes are looked at"""
+        out = []
+        for row, column in moves:
+            if (row, column) in self._effects:
+                effects = self._effects[row, column]
+            elif (row - 1, column - 1) in self._weights:
+                effects = [((row - 1, column - 1), None)]  # insert into an empty cell
+            else:
+                effects = []
+            delta = {}
+            for (x, y), source in effects:
+                old = self._cards[x][y]
+                new = card if source is None else self._cards[source[0]][source[1]]
+                w = self._weights[x, y]
+                if old:
+                    delta[old.suit] = delta.get(old.suit, 0) - w * old.value
+                if new:
+                    delta[new.suit] = delta.get(new.suit, 0) + w * new.value
+            out.append([self.score(suit) + delta.get(suit, 0) for suit in suits])
         return out
 
     def update(self, card, row, column):
@@ -99,10 +138,13 @@ class Board:
                 error = 'Please choose from empty cells {}'.format(l)
             else:
                 self._cards[row - 1][column - 1] = card
+                self._add_totals([(row - 1, column - 1)], 1)
                 discarded = 'Insert'  # Evaluates True for move, no card actually discarded.
             # Return is important here
             return discarded, error
 
+        line = self._line(row, column)
+        self._add_totals(line, -1)
         if 0 < row <= self.size:
             card_row = self._cards[row - 1]
             if column == 0:
@@ -163,8 +205,7 @@ class Board:
                 print('Invalid row/column')
             error = 'Invalid row/column'
             discarded = ''
-        if discarded:
-            discarded.discarded = True  # Set card attribute
+        self._add_totals(line, 1)
         return discarded, error
 
     def __repr__(self):
@@ -186,11 +227,8 @@ class AiBoard(Board):
         super().__init__(board.size)
 
     def test(self, board, card, row, column, suits):
-        # Copys current actual board and tests an update
-        self._cards = board.cards
-        self.update(card, row, column)
-
-        return [self.score(suit) for suit in suits]
+        # Scores if card were played on the actual board
+        return board.test_moves(card, [(row, column)], suits)[0]
 
 
 class Player:
@@ -204,21 +242,31 @@ class Player:
         self.ai = ai
         self.gm = gm
 
+    # the hand is a list in playing order, with a bitmask of its ranks kept alongside
+    @property
+    def hand(self):
+        return self._hand
+
+    @hand.setter
+    def hand(self, cards):
+        self._hand = list(cards)
+        self.mask = hand_mask(self._hand)
+
     def in_hand(self, card):
-        for c in self.hand:
-            if c.name == card or c == card:
-                return c
-                # return any(c.name == card for c in self.hand) or card in self.hand
+        # by Card or by name
+        if isinstance(card, Card):
+            return card if card.suit == self.suit and self.mask >> (card.id & 15) & 1 else None
+        rank = card_rank(card)
+        if rank and self.mask >> rank & 1:
+            return Card(RANK_NAMES[rank], self.suit)
 
     def play(self, card):
-        if not self.in_hand(card):
+        c = self.in_hand(card)
+        if not c:
             raise Exception('Card {} not in hand'.format(card))
-        for i, c in enumerate(self.hand):
-            if c.name == card or c == card:  # Either by name or card instance
-                c.played = True
-                del self.hand[i]
-                return True
-        raise Exception('Card not removed')
+        self._hand.remove(c)
+        self.mask ^= 1 << (c.id & 15)
+        return True
 
     def __repr__(self):
         if self.ai:
@@ -227,23 +275,172 @@ class Player:
             return '{} ({})'.format(self.name, self.suit)
 
 
+def dumps(board, players, discarded, p_turn, statement):
+    return b''.join(pickle.dumps(x) for x in (board, players, discarded, p_turn, statement))
+
+
 def dump(board, players, discarded, p_turn, statement, fname):
-    with open(fname, 'wb') as f:
-        pickle.dump(board, f)
-        pickle.dump(players, f)
-        pickle.dump(discarded, f)
-        pickle.dump(p_turn, f)
-        pickle.dump(statement, f)
+    write(fname, dumps(board, players, discarded, p_turn, statement))
+
+
+def write(fname, data):
+    # through a temporary file, so anything reading fname meanwhile gets the old game or the new one whole
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, fname)
+
+
+class _SavedCard:
+    # A card from a save made before cards were interned, which pickled each card's attributes. _upgrade swaps it
+    # for the interned card
+    def card(self):
+        return Joker() if self.name == 'Jkr' else Card(self.name, self.suit)
+
+
+class _Unpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module in ('curling', '__main__') and name in ('Card', 'Joker'):
+            return _SavedCard
+        return super().find_class(module, name)
+
+
+def _upgrade(board, players, discarded):
+    # Old saves hold their own card objects, each player's hand as a plain attribute, and the oldest ones no board
+    # tables
+    def card(c):
+        return c.card() if isinstance(c, _SavedCard) else c
+    board.joker = card(board.joker)
+    board._cards = [[card(c) for c in row] for row in board._cards]
+    if not hasattr(board, '_effects'):
+        board._tables()
+    for player in players:
+        hand = vars(player).pop('hand', None)
+        if hand is not None:
+            player.hand = [card(c) for c in hand]
+    return [card(c) for c in discarded]
+
+
+def load_from(f):
+    board = _Unpickler(f).load()
+    players = _Unpickler(f).load()
+    discarded = _Unpickler(f).load()
+    p_turn = _Unpickler(f).load()
+    statement = _Unpickler(f).load()
+    if isinstance(board.joker, _SavedCard):
+        discarded = _upgrade(board, players, discarded)
+    return board, players, discarded, p_turn, statement
 
 
 def load(fname):
     with open(fname, 'rb') as f:
-        board = pickle.load(f)
-        players = pickle.load(f)
-        discarded = pickle.load(f)
-        p_turn = pickle.load(f)
-        statement = pickle.load(f)
-    return board, players, discarded, p_turn, statement
+        return load_from(f)
+
+
+class SessionStore:
+    """Games kept in memory by file name, so the service functions below don't reload them on every call.
+    Changed games are written back when they drop out of the cache, every flush_interval seconds and at exit.
+    With flush_interval None nothing is written as games change: games dropped from the cache are kept pickled, and
+    the owner writes everything changed from take_writes() when it likes, e.g. off an event loop, then calls
+    written(). Until then those games are still loaded from memory, never from the files being written"""
+    def __init__(self, capacity=32, flush_interval=5.0):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self._games = collections.OrderedDict()  # fname -> [board, players, discarded, p_turn, statement]
+        self._dirty = set()
+        self._pending = {}  # fname -> pickled game dropped from the cache and not yet written
+        self._writing = {}  # fname -> pickled game handed out by take_writes and not yet written
+        self._last_flush = time.monotonic()
+
+    def cached(self, fname):
+        # whether get would load fname from memory rather than disk
+        return fname in self._games or fname in self._pending or fname in self._writing
+
+    def get(self, fname):
+        data = self._games.get(fname)
+        if data is not None:
+            self._games.move_to_end(fname)
+        elif fname in self._pending:
+            data = self._games[fname] = list(load_from(io.BytesIO(self._pending.pop(fname))))
+            self._dirty.add(fname)
+            self._evict()
+        elif fname in self._writing:
+            data = self.add(fname, load_from(io.BytesIO(self._writing[fname])))
+        else:
+            data = self.add(fname, load(fname))
+        return data
+
+    def add(self, fname, data):
+        # a game as it is on disk
+        data = self._games[fname] = list(data)
+        self._evict()
+        return data
+
+    def put(self, fname, data):
+        self._games[fname] = list(data)
+        self._games.move_to_end(fname)
+        self._pending.pop(fname, None)
+        self.changed(fname)
+        self._evict()
+
+    def changed(self, fname):
+        self._dirty.add(fname)
+        if self.flush_interval is not None and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self, fname=None):
+        if fname is None:
+            writes = self.take_writes()
+            try:
+                for name, data in writes:
+                    write(name, data)
+            except BaseException:
+                self.written(writes, False)
+                raise
+            self.written(writes)
+            self._last_flush = time.monotonic()
+        else:
+            if fname in self._pending:
+                write(fname, self._pending.pop(fname))
+            if fname in self._dirty:
+                dump(*self._games[fname], fname)
+                self._dirty.discard(fname)
+
+    def take_writes(self):
+        """(fname, pickled game) for every game changed since the last call, for the owner to write"""
+        writes = list(self._pending.items())
+        writes += [(fname, dumps(*self._games[fname])) for fname in self._dirty]
+        self._pending.clear()
+        self._dirty.clear()
+        self._writing.update(writes)
+        return writes
+
+    def written(self, writes, ok=True):
+        """Mark the games from take_writes as on disk, or with ok False as still to write, for the next call"""
+        for fname, data in writes:
+            if self._writing.get(fname) is not data:
+                continue  # taken again since
+            del self._writing[fname]
+            if ok:
+                continue
+            if fname in self._games:
+                self._dirty.add(fname)
+            else:
+                self._pending[fname] = data
+
+    def _evict(self):
+        while len(self._games) > self.capacity:
+            fname, data = self._games.popitem(last=False)
+            if fname in self._dirty:
+                self._dirty.discard(fname)
+                if self.flush_interval is None:
+                    self._pending[fname] = dumps(*data)
+                else:
+                    dump(*data, fname)
+
+
+SESSIONS = SessionStore()
+atexit.register(SESSIONS.flush)
 
 
 def setup(fname='curling.pi', save=1):
@@ -256,23 +453,26 @@ def setup(fname='curling.pi', save=1):
     player = players[p_turn]
     statement, score = statement_and_score(board, player)
     if save:
-        dump(board, players, discarded, p_turn, statement, fname)
+        SESSIONS.put(fname, [board, players, discarded, p_turn, statement])
+        SESSIONS.flush(fname)
     return board, players, discarded, p_turn, statement
 
 
 def information(fname='curling.pi'):
-    board, players, discarded, p_turn, statement = load(fname)
-    if not any(x.hand for x in players):
-        statement = final(fname)
-    elif players[p_turn].ai:
-        random_ai_turn(players[p_turn], board, players, discarded, p_turn, statement)
-        # For more ai
-        information(fname)
-        board, players, discarded, p_turn, statement = load(fname)
+    data = SESSIONS.get(fname)
+    board, players, discarded = data[:3]
+    # The AIs play until it's a person's turn
+    while any(x.hand for x in players) and players[data[3]].ai:
+        random_ai_turn(players[data[3]], board, players, discarded, data[3], data[4], save=0, data=data)
+        SESSIONS.changed(fname)
         if PRINT:
             print(board)
             print('\n'.join('{}: {}'.format(player, player.score) for player in players))
-            print(statement)
+            print(data[4])
+    if any(x.hand for x in players):
+        statement = data[4]
+    else:
+        statement = final(fname)
 
     return board, '\n'.join('{}: {}'.format(player, player.score) for player in players), statement
 
@@ -287,10 +487,10 @@ def statement_and_score(board, next_player):
 
 
 def turn(card, row, column, save=1, fname='curling.pi', data=None):
-    if data:
-        board, players, discarded, p_turn, statement = data
-    else:
-        board, players, discarded, p_turn, statement = load(fname)
+    stored = not data
+    if stored:
+        data = SESSIONS.get(fname)
+    board, players, discarded, p_turn, statement = data
     player = players[p_turn]
     # #print('Statement')
     # while 1:
@@ -327,15 +527,21 @@ def turn(card, row, column, save=1, fname='curling.pi', data=None):
         statement, score = statement_and_score(board, next_player)
         next_player.score += score
 
-        if save:
+        # data is the game's list in SESSIONS (or the caller's), so it has to move on to the next turn too
+        if isinstance(data, list):
+            data[3], data[4] = p_turn, statement
+        if save and stored:
+            SESSIONS.changed(fname)
+        elif save:
             dump(board, players, discarded, p_turn, statement, fname)
         return 'Done'
     return error
 
 
 def final(fname='curling.pi', data=None, save=1):
-    if not data:
-        data = load(fname)
+    stored = not data
+    if stored:
+        data = SESSIONS.get(fname)
     board, players, discarded, p_turn, statement = data
     if not board.final:
         if PRINT:
@@ -348,7 +554,11 @@ def final(fname='curling.pi', data=None, save=1):
     board.finalise()
     if PRINT:
         print(statement)
-    if save:
+    if isinstance(data, list):
+        data[4] = statement
+    if save and stored:
+        SESSIONS.changed(fname)
+    elif save:
         dump(board, players, discarded, p_turn, statement, fname)
     return statement
 
@@ -381,7 +591,7 @@ def text_turn(player, board, players, discarded, p_turn, statement):
 
 
 # Random AI
-def random_ai_turn(player, board, players, discarded, p_turn, statement, save=1):
+def random_ai_turn(player, board, players, discarded, p_turn, statement, save=1, data=None):
     if player.hand:
         # card = random.choice(player.hand)
         card = max(player.hand, key=lambda x: x.value)
@@ -400,12 +610,13 @@ def random_ai_turn(player, board, players, discarded, p_turn, statement, save=1)
         # An initial choice, may be overridden
         row, column = random.choice(empty)
         if player.gm:
-            e1 = [(r, c) for (r, c) in empty if min_choice <= r <= max_choice and min_choice <= c <= max_choice]
+            in_rows, in_cols, in_both = bounded_cells(board.size, min_choice, max_choice)
+            e1 = [rc for rc in empty if rc in in_both]
             if e1:
                 row, column = random.choice(e1)
             else:
-                ec = [(r, c) for (r, c) in empty if min_choice <= c <= max_choice]
-                er = [(r, c) for (r, c) in empty if min_choice <= r <= max_choice]
+                ec = [rc for rc in empty if rc in in_cols]
+                er = [rc for rc in empty if rc in in_rows]
                 insert = random.choice(('R', 'C'))
                 if er and (insert == 'R' or not ec):
                     row, column = random.choice(er)
@@ -421,13 +632,24 @@ def random_ai_turn(player, board, players, discarded, p_turn, statement, save=1)
             column = random.choice((0, board.size + 1))
             row = random.randint(min_choice, max_choice)
 
-    message = turn(card, row, column, save=save, data=[board, players, discarded, p_turn, statement])
+    if data is None:
+        data = [board, players, discarded, p_turn, statement]
+    message = turn(card, row, column, save=save, data=data)
     if message != "Done":
         raise Exception("ai error")
 
 
-def one_set_ai(player, board, players, discarded, p_turn, statement, save=1):
-    ai_board = AiBoard(board)
+def book_move(board, players, p_turn):
+    # (card, row, column) from the opening book in BOOK, if there is one and it has this position
+    if BOOK is None:
+        return None
+    move = BOOK.lookup([c.id if c else 0 for r in board._cards for c in r], players, p_turn)
+    if move:
+        rank, row, column = move
+        return players[p_turn].in_hand(RANK_NAMES[rank]), row, column
+
+
+def one_set_ai(player, board, players, discarded, p_turn, statement, save=1, data=None):
     suits = [p.suit for p in players]
     if player.hand:
         # Card don't score immediately, might as well be high
@@ -445,27 +667,31 @@ def one_set_ai(player, board, players, discarded, p_turn, statement, save=1):
     else:
         choices = [(0, i + 1) for i in range(board.size)] + [(6, i + 1) for i in range(board.size)] + \
                   [(i + 1, 0) for i in range(board.size)] + [(i + 1, 6) for i in range(board.size)]
-    best = [(cards[0], choices[0][0], choices[0][1])]
-    best_score = 0
-    for card in cards:
-        for r, c in choices:
-            scores = ai_board.test(board, card, r, c, suits)
-            score = 2 * scores[p_turn] - sum(scores)
-            if score > best_score:
-                best = [(card, r, c)]
-                best_score = score
-            elif score == best_score:
-                best.append((card, r, c))
-    card, row, column = random.choice(best)
-    message = turn(card, row, column, save=save, data=[board, players, discarded, p_turn, statement])
+    move = book_move(board, players, p_turn) if empty else None
+    if move:
+        card, row, column = move
+    else:
+        best = [(cards[0], choices[0][0], choices[0][1])]
+        best_score = 0
+        for card in cards:
+            for (r, c), scores in zip(choices, board.test_moves(card, choices, suits)):
+                score = 2 * scores[p_turn] - sum(scores)
+                if score > best_score:
+                    best = [(card, r, c)]
+                    best_score = score
+                elif score == best_score:
+                    best.append((card, r, c))
+        card, row, column = random.choice(best)
+    if data is None:
+        data = [board, players, discarded, p_turn, statement]
+    message = turn(card, row, column, save=save, data=data)
     if message != "Done":
         raise Exception("ai error")
 
 
 def ai_on_off(player_n, ai_on, fname='curling.pi'):
-    board, players, discarded, p_turn, statement = load(fname)
-    players[player_n].ai = ai_on
-    dump(board, players, discarded, p_turn, statement, fname)
+    SESSIONS.get(fname)[1][player_n].ai = ai_on
+    SESSIONS.changed(fname)
 
 
 def main(ai=(0, 0, 0), gm=(0, 0, 0), fname='curling.pi'):
@@ -497,40 +723,15 @@ def main(ai=(0, 0, 0), gm=(0, 0, 0), fname='curling.pi'):
     return [p.score for p in players]
 
 
-def averages(runs, gm=(0, 0, 0)):
+def averages(runs, gm=(0, 0, 0), workers=None, seed=None):
+    # The functions here have no game object to carry a verbose flag, so PRINT stays their switch. It's off for
+    # the runs and put back after
     global PRINT
-    PRINT = False
-    results = []
-    for _ in range(runs):
-        results.append(main((1, 1, 1), gm))
-
-    end = [0, 0, 0]
-    diff = [0, 0, 0]
-    av_m = []
-    for a, b, c in results:
-        m = max(a, b, c)
-        if a == m:
-            end[0] += 1
-        if b == m:
-            end[1] += 1
-        if c == m:
-            end[2] += 1
-
-        diff[0] += a - b
-        diff[1] += b - c
-        diff[2] += c - a
-        av_m.append(m)
-
-    print("Wins", end)
-    print("Av score")
-    for i in range(3):
-        diff[i] /= runs
-    for i in range(len(results[0])):
-        print(sum(x[i] for x in results) / runs)
-
-    print("Margins:", diff)
-    print("Av winning score:", sum(av_m) / runs)
-    print()
+    printing, PRINT = PRINT, False
+    try:
+        play_games(functools.partial(main, (1, 1, 1), gm), runs, workers, seed).report()
+    finally:
+        PRINT = printing
 
 
 if __name__ == '__main__':
@@ -1,41 +1,77 @@
-import pickle
 import random
+import concurrent.futures
 import copy
+import io
+import math
+import os
+import pickle
+import struct
+import threading
+import time
+from collections import defaultdict
+
+from cards import RANKS, RANK_NAMES, VALUES, SUITS, suit_id, Card, Joker, card_from_id, card_rank, hand_mask
+from movegen import MoveGen
+from selfplay import play_games
+from symmetry import canonical_hash, symmetries
 
 PRINT = True
+# tenths of a card's value AITreeSearch's heuristic adds for it being on the board, in a corner or anywhere else
+REGION = 5
+CORNER = 2
 
 
-class Card:
-    def __init__(self, name, suit):
-        self.name = str(name)
-        if self.name == '10':
-            self.name = '0'  # For spacing
-        if name == '*':
-            self.value = 0
-        elif name in ['J', 'Q', 'K']:
-            self.value = 10
-        elif name == 'A':
-            self.value = 1
-        else:
-            self.value = int(name)
-        self.suit = suit
-        self.played = False
-        self.discarded = False
+# Flat cell indices shifted by each edge move, keyed by board size then (row, column) of the move.
+# Each path runs from the cell the card is inserted into to the cell whose card is discarded, skipping the joker.
+_EDGE_PATHS = {}
 
-    def __repr__(self):
-        return '{} {}'.format(self.name, self.suit)
 
+def edge_paths(size):
+    if size not in _EDGE_PATHS:
+        joker_pos = size // 2
+        paths = {}
+        for i in range(1, size + 1):
+            line = [(i - 1) * size + c for c in range(size)]  # row i, left to right
+            if i == joker_pos + 1:
+                line.remove(joker_pos * size + joker_pos)
+            paths[(i, 0)] = tuple(line)
+            paths[(i, size + 1)] = tuple(reversed(line))
+            line = [r * size + i - 1 for r in range(size)]  # column i, top to bottom
+            if i == joker_pos + 1:
+                line.remove(joker_pos * size + joker_pos)
+            paths[(0, i)] = tuple(line)
+            paths[(size + 1, i)] = tuple(reversed(line))
+        _EDGE_PATHS[size] = paths
+    return _EDGE_PATHS[size]
 
-class Joker(Card):
-    def __init__(self):
-        self.name = 'Jkr'
-        self.suit = ''
-        self.value = 0
-        self.played = True
-        self.discarded = False
 
-    def __repr__(self):
-        return self.name
+# Zobrist keys, drawn on first use from their own generator so hashing never disturbs the game's random choices.
+# Drawing takes a lock, so threads searching at once can't give the same item two keys; looking up a key drawn
+# already doesn't
+_zobrist_random = random.Random(2018)
+_zobrist_lock = threading.Lock()
+
+
+class ZobristKeys(dict):
+    def __missing__(self, item):
+        with _zobrist_lock:
+            key = self.get(item)
+            if key is None:
+                key = self[item] = _zobrist_random.getrandbits(64)
+        return key
+
+
+ZOBRIST = ZobristKeys()  # keyed by ('hand', player index, card id), ('turn', p_turn), ('score', player index, score)
+_ZOBRIST_CELLS = {}
+
+
+def zobrist_cells(size):
+    # one ZobristKeys per cell, keyed by card id
+    if size not in _ZOBRIST_CELLS:
+        with _zobrist_lock:
+            if size not in _ZOBRIST_CELLS:
+                _ZOBRIST_CELLS[size] = [ZobristKeys() for _ in range(size * size)]
+    return _ZOBRIST_CELLS[size]
 
 
 class Board:
@@ -43,24 +79,76 @@ class Board:
         self._final = 0
         self.size = size
         self.joker = Joker()
-        self._cards = []
-        for _ in range(size):
-            self._cards.append([Card('*', '*')] * size)
+        blank = Card('*', '*')
+        self._deck = {blank.id: blank, self.joker.id: self.joker}  # card id -> Card for everything placed
+        self._cells = [blank.id] * (size * size)  # row major
         self.joker_pos = size // 2
-        self._cards[self.joker_pos][self.joker_pos] = self.joker
+        self._cells[self.joker_pos * size + self.joker_pos] = self.joker.id
         if empty == 'Default':
             empty = [(0, 0), (0, 1), (0, 3), (0, 4), (1, 0), (1, 4), (3, 0), (3, 4), (4, 0), (4, 1), (4, 3), (4, 4)]
+        self._empty = set()
         for x, y in empty:
-            self._cards[x][y] = ''
+            self._cells[x * size + y] = 0
+            self._empty.add(x * size + y)
         self.scoring_pos = [(1, [(self.joker_pos - 1, self.joker_pos - 1), (self.joker_pos - 1, self.joker_pos + 1),
                                 (self.joker_pos + 1, self.joker_pos - 1), (self.joker_pos + 1, self.joker_pos + 1)]),
                             (2, [(self.joker_pos - 1, self.joker_pos), (self.joker_pos, self.joker_pos - 1),
                                 (self.joker_pos + 1, self.joker_pos), (self.joker_pos, self.joker_pos + 1)])]
-
+        self._weights = [0] * (size * size)
+        for s, l in self.scoring_pos:
+            for x, y in l:
+                self._weights[x * size + y] = s
+        self._paths = edge_paths(size)
+        # scoring cells along each edge path, the only cells whose change affects the running totals
+        self._touched = {move: tuple((i, self._weights[i]) for i in path if self._weights[i])
+                         for move, path in self._paths.items()}
+        # for each edge path, its scoring cells and the cell each takes its card from (None for the card played), so a
+        # move can be scored without playing it
+        self._effects = {move: tuple((i, self._weights[i], path[k - 1] if k else None)
+                                     for k, i in enumerate(path) if self._weights[i])
+                         for move, path in self._paths.items()}
+        # tenths of a card's value the AI's heuristic counts for the cell it's on: 0.5 but for 0.2 in the corners
+        self._regions = [REGION] * (size * size)
+        for i in (0, size - 1, size * (size - 1), size * size - 1):
+            self._regions[i] = CORNER
+        # the corners along each edge path, the only cells where a shifted card's region weight changes
+        self._corners = {move: tuple((i, self._regions[i] - REGION) for i in path if self._regions[i] != REGION)
+                         for move, path in self._paths.items()}
+        self._zobrist = zobrist_cells(size)
+        # what each update changed: (cells, their previous ids, previous hash, previous totals and region sums), so
+        # undoing it is a straight copy back
+        self._changes = []
+        self._recount()
+
+    def _recount(self):
+        # rebuild everything update keeps incrementally from the cells
+        self._totals = defaultdict(int)  # suit id -> points currently on the scoring cells
+        for i, w in enumerate(self._weights):
+            if w:
+                self._totals[self._cells[i] >> 4] += w * VALUES[self._cells[i] & 15]
+        self._region = defaultdict(int)  # suit id -> tenths of points of its cards, weighted by _regions
+        for i, c in enumerate(self._cells):
+            if c:
+                self._region[c >> 4] += self._regions[i] * VALUES[c & 15]
+        self.hash = 0  # Zobrist hash of the cells, kept up to date by update
+        for i, c in enumerate(self._cells):
+            self.hash ^= self._zobrist[i][c]
+
+    def set_cells(self, cells):
+        # replace every cell with the given card ids, e.g. from a snapshot
+        self._cells = list(cells)
+        for c in self._cells:
+            if c and c not in self._deck:
+                self._deck[c] = card_from_id(c)
+        self._empty = {i for i, c in enumerate(self._cells) if not c}
+        self._changes = []
+        self._recount()
 
     @property
     def cards(self):
-        return [r[:] for r in self._cards]
+        deck = self._deck
+        return [[deck[c] if c else '' for c in self._cells[r:r + self.size]]
+                for r in range(0, self.size * self.size, self.size)]
 
     def finalise(self):
         self._final = 1
@@ -68,22 +156,45 @@ class Board:
     def unfinalise(self):
         self._final = 0
 
+    def copy(self):
+        # an independent board to search on. The tables are shared, and so is the deck, which only grows and always
+        # maps an id to the same card; the undo history starts empty
+        board = Board.__new__(Board)
+        board.__dict__.update(self.__dict__)
+        board._cells = self._cells[:]
+        board._empty = set(self._empty)
+        board._totals = self._totals.copy()
+        board._region = self._region.copy()
+        board._changes = []
+        return board
+
+    def test_moves(self, card, moves, suits):
+        """Board scores for each suit id in suits after playing card at each (row, column) in moves, without playing
+        it. Only the scoring cells a move changes are looked at"""
+        out = []
+        cells = self._cells
+        for row, column in moves:
+            effects = self._effects.get((row, column))
+            if effects is None:
+                i = (row - 1) * self.size + column - 1  # insert into an empty cell
+                effects = ((i, self._weights[i], None),) if self._weights[i] else ()
+            delta = {}
+            for i, w, source in effects:
+                old = cells[i]
+                new = card.id if source is None else cells[source]
+                if old:
+                    delta[old >> 4] = delta.get(old >> 4, 0) - w * VALUES[old & 15]
+                delta[new >> 4] = delta.get(new >> 4, 0) + w * VALUES[new & 15]
+            out.append([self._totals[suit] + delta.get(suit, 0) for suit in suits])
+        return out
+
     def get_empty(self):
-        if any(not x for r in self._cards for x in r):
-            return [(r + 1, c + 1) for r in range(self.size) for c in range(self.size) if not self._cards[r][c]]
-        else:
-            return []
+        return [(i // self.size + 1, i % self.size + 1) for i in sorted(self._empty)]
 
     def score(self, player):
-        out = 0
-        if not self._final:
-            for s, l in self.scoring_pos:
-                for x, y in l:
-                    if self._cards[x][y] and self._cards[x][y].suit == player.suit:
-                        out += s * self._cards[x][y].value
-        else:
+        if self._final:
             raise Exception('Trying to score points on a finalised board for {}'.format(player.name))
-        return out
+        return self._totals[suit_id(player.suit)]
 
     def update(self, ply, undo=False, undiscard=''):
         '''Starting from the outside left as column 0, top as row 0, place your card outisde the space you want to
@@ -96,66 +207,84 @@ class Board:
             card = ply.card
 
         error = ''
-        empty = self.get_empty()
-        if empty and not undo:
-            if (ply.row, ply.column) not in empty:
-                if PRINT:
-                    print('Please choose from empty cells', empty)
+        cells = self._cells
+        totals = self._totals
+        if undo and self._changes:
+            changed, previous, self.hash, self._totals, self._region = self._changes.pop()
+            for i, c in zip(changed, previous):
+                cells[i] = c
+                if not c:
+                    self._empty.add(i)
+            return 'undo', error
+        elif self._empty and not undo:
+            i = (ply.row - 1) * self.size + ply.column - 1
+            if not (0 < ply.row <= self.size and 0 < ply.column <= self.size) or i not in self._empty:
+                empty = self.get_empty()
                 discarded = ''
                 error = 'Please choose from empty cells {}'.format(empty)
             else:
-                self._cards[ply.row - 1][ply.column - 1] = card
+                self._changes.append(((i,), (0,), self.hash, totals.copy(), self._region.copy()))
+                cells[i] = card.id
+                self._deck[card.id] = card
+                self._empty.remove(i)
+                self.hash ^= self._zobrist[i][0] ^ self._zobrist[i][card.id]
+                if self._weights[i]:
+                    totals[card.id >> 4] += self._weights[i] * card.value
+                self._region[card.id >> 4] += self._regions[i] * card.value
                 discarded = 'Insert'  # Evaluates True for move, no card actually discarded.
             # Return is important here
             return discarded, error
         elif undo and self.is_insert(ply):
-            self._cards[ply.row - 1][ply.column - 1] = ''
-            
+            i = (ply.row - 1) * self.size + ply.column - 1
+            if self._weights[i]:
+                self._totals[cells[i] >> 4] -= self._weights[i] * VALUES[cells[i] & 15]
+            self._region[cells[i] >> 4] -= self._regions[i] * VALUES[cells[i] & 15]
+            self.hash ^= self._zobrist[i][cells[i]] ^ self._zobrist[i][0]
+            cells[i] = 0
+            self._empty.add(i)
             return 'undo', error
 
-        # Check insertion condition, determine if a row or column is being inserted to
-        if 0 < ply.row <= self.size and ply.column in (0, self.size + 1):
-            tempcards = self._cards
-            ins_row = True  # row or column?
-            ins_left = (ply.column == 0) ^ undo  # left(top) or right(bottom)? (reverse if undoing)
-            ins_pos = ply.row  # row(col) index
-        elif 0 < ply.column <= self.size and ply.row in (0, self.size + 1):
-            # treat row and column insertion the same by transposing the card list for one of them
-            tempcards = [x for x in map(list, zip(*self._cards))]
-            # column insertion
-            ins_row = False
-            ins_left = (ply.row == 0) ^ undo
-            ins_pos = ply.column
-        else:
+        path = self._paths.get((ply.row, ply.column))
+        if path is None:
             discarded = ''
-            if PRINT:
-                print('Invalid row/column')
             error = 'Invalid row/column'
             raise Exception('Invalid row/column, ply {}'.format(repr(ply)))
             return discarded, error
 
-        # treat left and right insertion the same by reversing in one case
-        if ins_left:
-            card_row = tempcards[ins_pos - 1]
-        else:
-            card_row = tempcards[ins_pos - 1][::-1]
-
-        discarded = card_row[-1]
-        new_row = [card] + card_row[:-1]
-        # put the joker back in the right place if we're in that row/col
-        if ins_pos == self.joker_pos + 1:
-            new_row.insert(self.joker_pos, new_row.pop(self.joker_pos + 1))
-
-        # undo the row reverse and transpose
-        if not ins_left:
-            new_row.reverse()
-        if ins_row:
-            self._cards[ins_pos - 1] = new_row
-        else:
-            tempcards[ins_pos - 1] = new_row
-            self._cards = [x for x in map(list, zip(*tempcards))]
+        touched = self._touched[(ply.row, ply.column)]
+        corners = self._corners[(ply.row, ply.column)]
+        region = self._region
+        if not undo:
+            self._changes.append((path, [cells[i] for i in path], self.hash, totals.copy(), region.copy()))
+        for i, w in touched:
+            totals[cells[i] >> 4] -= w * VALUES[cells[i] & 15]
+        for i, w in corners:
+            region[cells[i] >> 4] -= w * VALUES[cells[i] & 15]
+        zobrist = self._zobrist
+        h = self.hash
+        for i in path:
+            h ^= zobrist[i][cells[i]]
+
+        # undoing pushes the discarded card back in from the other end
+        if undo:
+            path = path[::-1]
+        discarded = self._deck[cells[path[-1]]]
+        for k in range(len(path) - 1, 0, -1):
+            cells[path[k]] = cells[path[k - 1]]
+        cells[path[0]] = card.id
+        self._deck[card.id] = card
+
+        for i, w in touched:
+            totals[cells[i] >> 4] += w * VALUES[cells[i] & 15]
+        # every card on the path moves one cell, so only the cards in and out and the corners change the region sums
+        region[card.id >> 4] += REGION * card.value
+        region[discarded.id >> 4] -= REGION * discarded.value
+        for i, w in corners:
+            region[cells[i] >> 4] += w * VALUES[cells[i] & 15]
+        for i in path:
+            h ^= zobrist[i][cells[i]]
+        self.hash = h
 
-        discarded.discarded = (not undo)  # Set card attribute
         return discarded, error
 
 #    def is_setup_phase(self):
@@ -168,7 +297,7 @@ class Board:
         
     def __repr__(self):
         out = []
-        for row in self._cards:
+        for row in self.cards:
             line = []
             for card in row:
                 if not card:
@@ -208,30 +337,52 @@ class Player:
     def postinit(self):
         pass
 
+    # the hand is a list in playing order, with a bitmask of its ranks kept alongside
+    @property
+    def hand(self):
+        return self._hand
+
+    @hand.setter
+    def hand(self, cards):
+        self._hand = list(cards)
+        self.mask = hand_mask(self._hand)
+        self.hand_value = sum(c.value for c in self._hand)
+
     def in_hand(self, card):
-        for c in self.hand:
-            if c.name == card or c == card:
-                return c
-                # return any(c.name == card for c in self.hand) or card in self.hand
+        # by Card or by name
+        if isinstance(card, Card):
+            return card if card.suit == self.suit and self.mask >> (card.id & 15) & 1 else None
+        rank = card_rank(card)
+        if rank and self.mask >> rank & 1:
+            return Card(RANK_NAMES[rank], self.suit)
 
     def play(self, card):
-        if not self.in_hand(card):
+        c = self.in_hand(card)
+        if not c:
             raise Exception('Card {} not in hand'.format(card))
-        for i, c in enumerate(self.hand):
-            if c.name == card or c == card:  # Either by name or card instance
-                c.played = True
-                del self.hand[i]
-                return True
-        raise Exception('Card not removed')
+        self._hand.remove(c)
+        self.mask ^= 1 << (c.id & 15)
+        self.hand_value -= c.value
+        return True
 
     def unplay(self, card):
         if self.in_hand(card):
             raise Exception('Card {} already in hand during tree backtrack'.format(card))
-        if card != '':
-            card.played = False
-        self.hand.append(card)
+        self._hand.append(card)
+        self.mask |= 1 << (card.id & 15)
+        self.hand_value += card.value
         return True
 
+    def copy(self):
+        # a plain Player with the same hand and score, to play on without touching this one
+        player = Player.__new__(Player)
+        player.name = self.name
+        player.suit = self.suit
+        player.score = self.score
+        player.AI = self.AI
+        player.hand = self._hand
+        return player
+
     def alter_score(self, delta):
         if delta > 500:
             raise Exception('Trying to add score above 500')
@@ -302,117 +453,637 @@ class AITreeSearch(Player):
     def postinit(self):
         self.AI = True
         self.depth = 2  # tree search depth (plies)
+        # 'maxn' searches every ply, 'shallow' is max-n with shallow pruning on win-share values,
+        # 'paranoid' assumes the other players all play against us so alpha-beta applies
+        self.mode = 'maxn'
+        self.temperature = 10.0  # spread of the win-share values used by 'shallow'
         self.t_game = []  # to hold the local version of the game
-
-    def make_move(self, game_state):
-        # entry point
-        global PRINT
-        PRINT = False
-        print("Enter AITree make_move")
-        # create local version of the game without letting it enter its game loop
-        self.t_game = Game(game_state, autostart=False)  # copy.deepcopy(Game(game_state, autostart = False))
+        self.tt = TranspositionTable()
+        self.tt_mode = self.mode  # table entries are only comparable within one mode
+        self.nodes = 0
+        # per-move budget for iterative deepening, used in place of the fixed depth when either is set
+        self.time_limit = None  # seconds
+        self.node_limit = None
+        self.max_depth = 12
+        self.completed_depth = None  # deepest search finished within the budget on the last move
+        self._deadline = float('inf')
+        self._node_limit = float('inf')
+        self.best_value = None  # the searched value of the last move, one item per player
+        self.workers = 1  # processes to split the root plies of a fixed depth search across
+        self.pool = None  # started by the first parallel search, shut down by close
+        self.book = None  # an openings.OpeningBook to play the setup phase from
+        self.symmetry = False  # store setup positions in the table once for all 8 rotations and reflections
+        self.endgame = None  # an endgame.EndgameSolver to play the last few plies exactly
+        self.movegen = MoveGen()  # set movegen.full_hand to search a card of every value, not just the top and bottom
+        self._plies = {}  # Ply for each move code and player, so a search makes each one once
+
+    def __getstate__(self):
+        # the process pool can't be pickled with the player, it's started again when needed
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # stop the worker processes, a later parallel search starts new ones
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def make_move(self, game_state, time_limit=None, node_limit=None):
+        # entry point. A time limit counts from here, so setting up the search comes out of it
+        start = time.perf_counter()
+        if self.book is not None and game_state.board._empty:
+            ply = self.book.ply(game_state)
+            if ply:
+                return ply
+        # search on a copy of the game, so the live board and players are never touched
+        self.t_game = Game(game_state.fork(), autostart=False, verbose=False)
+        if self.endgame is not None and self.endgame.applies(self.t_game):
+            self.best_value = self.final_values(self.endgame.final_scores(self.t_game))
+            return self.endgame.best_ply(self.t_game)
+        if self.tt_mode != self.mode:
+            self.tt.clear()
+            self.tt_mode = self.mode
+        self.tt.new_search()
+        self.nodes = 0
+        self.new_search(self.t_game)
 
         # do a tree search recursively to find the best ply and its expected scores
-        bestscores, bestply = self.tree_search(self.t_game, self.depth)
-
-        # point the resulting card object to the actual card in the real game
-        for card in self.hand:
-            if card.name == bestply.card.name:
-                bestply.card = card
-        print("Exit AITree make_move, best scores: ", bestscores)
-        PRINT = True
+        if time_limit is None:
+            time_limit = self.time_limit
+        if node_limit is None:
+            node_limit = self.node_limit
+        if time_limit is None and node_limit is None:
+            if self.workers > 1:
+                bestscores, bestply = self.parallel_search(self.t_game, self.depth)
+            else:
+                bestscores, bestply = self.search(self.t_game, self.depth)
+        else:
+            bestscores, bestply = self.deepening_search(self.t_game, time_limit, node_limit, start)
+
+        self.best_value = bestscores
         return bestply
 
-    # given a game state, generate all the moves the current player could make
-    def enum_plies(self, game):
-        # assuming we have cards left to play
-        player = game.players[game.p_turn]
-        card_options = sorted(player.hand, key=lambda x: -x.value)  # cards ordered high-low
-        empty = game.board.get_empty()
-        if empty:
-            rowcol_options = empty
+    def search(self, game, depth):
+        if self.mode == 'paranoid':
+            return self.paranoid_search(game, depth, -float('inf'), float('inf'), game.p_turn)
+        elif self.mode == 'shallow':
+            return self.shallow_search(game, depth, float('inf'))
+        return self.tree_search(game, depth)
+
+    # search one ply deeper each time until the budget runs out, keeping the result of the last complete depth.
+    # Each iteration leaves its best plies in the table, which the next one searches first. The time limit
+    # counts from start, the time make_move was called
+    def deepening_search(self, game, time_limit, node_limit, start=None):
+        if start is None:
+            start = time.perf_counter()
+        root_plies = len(game.plyhistory)
+        remaining = sum(len(p.hand) for p in game.players)
+        # the one ply search always completes so there is a move to return
+        best = self.search(game, 0)
+        self.completed_depth = 0
+        self._deadline = start + time_limit if time_limit is not None else float('inf')
+        self._node_limit = node_limit if node_limit is not None else float('inf')
+        try:
+            for depth in range(1, min(self.max_depth, remaining)):
+                best = self.search(game, depth)
+                self.completed_depth = depth
+        except SearchTimeout:
+            while len(game.plyhistory) > root_plies:
+                game.unmake_move()
+        finally:
+            self._deadline = float('inf')
+            self._node_limit = float('inf')
+        return best
+
+    # Give each worker process a snapshot of the game and a share of the root plies, then pick the best of their
+    # values in the same order a serial search would
+    def parallel_search(self, game, depth):
+        if self.pool is None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        if self.mode == 'maxn':
+            moves = self.movegen.moves(game)
         else:
-            bsize = game.board.size
-            rowcol_options = [(0, i) for i in range(1, bsize + 1)] + \
-                             [(bsize + 1, i) for i in range(1, bsize + 1)] + \
-                             [(i, 0) for i in range(1, bsize + 1)] + \
-                             [(i, bsize + 1) for i in range(1, bsize + 1)]
-
-        #choose either the highest or lowest value card
-        if len(card_options) > 1:
-            card_choices = [card_options[0], card_options[-1]]
+            moves = self.ordered_moves(game)
+        plies = [self.code_ply(game, code) for code in moves]
+        jobs = list(enumerate(moves))
+        snapshot = game.get_game_state().snapshot()
+        settings = (self.mode, self.temperature, self.movegen.full_hand, self.endgame)
+        futures = [self.pool.submit(_search_root_plies, snapshot, settings, depth, jobs[w::self.workers])
+                   for w in range(min(self.workers, len(jobs)))]
+        values = [None] * len(plies)
+        for future in futures:
+            results, nodes = future.result()
+            self.nodes += nodes
+            for i, value in results:
+                values[i] = value
+
+        best = ''
+        bestply = ''
+        for value, ply in zip(values, plies):
+            if best == '' or value[game.p_turn] > best[game.p_turn]:
+                best = value
+                bestply = ply
+        return best, bestply
+
+    # value of the position after ply, searched to depth below it with this player's mode. For paranoid, a
+    # value no better than alpha is only an upper bound
+    def ply_value(self, game, ply, depth, alpha=-float('inf')):
+        root = game.p_turn
+        game.make_move(ply)
+        self.count_node()
+        if game.gameover or depth == 0:
+            value = self.heuristic_eval(game)
+            if self.mode == 'shallow':
+                value = self.win_shares(value)
+        elif self.mode == 'paranoid':
+            value = self.paranoid_search(game, depth - 1, alpha, float('inf'), root)[0]
+        elif self.mode == 'shallow':
+            value = self.shallow_search(game, depth - 1, float('inf'))[0]
         else:
-            card_choices = [card_options[0]]
-            
-        for card in card_choices:
-            for rowcol in rowcol_options:
-                yield Ply(card, rowcol[0], rowcol[1])
+            value = self.tree_search(game, depth - 1)[0]
+        game.unmake_move()
+        return value
+
+    def count_node(self):
+        self.nodes += 1
+        if self.nodes > self._node_limit or time.perf_counter() > self._deadline:
+            raise SearchTimeout()
+
+    # start a search of game, which may be for a different game or board size than the last one
+    def new_search(self, game):
+        self.movegen.reset(game.board.size)
+        self._plies = {}
+
+    # the Ply for a move code (see movegen) of the player to move
+    def code_ply(self, game, code):
+        key = code * len(game.players) + game.p_turn
+        ply = self._plies.get(key)
+        if ply is None:
+            rank, row, column = self.movegen.table.decode(code)
+            card = next(c for c in game.players[game.p_turn].hand if c.id & 15 == rank)
+            ply = self._plies[key] = Ply(card, row, column)
+        return ply
+
+    # the table key for this position and the transform (see symmetry) from it to the orientation it's stored in
+    def tt_key(self, game):
+        if self.symmetry and game.board._empty:
+            t, h = canonical_hash(game.board)
+            return h ^ game._hash, t
+        return game.hash, 0
+
+    # a ply into or out of the orientation the table stores its position in
+    def to_table(self, ply, t, game):
+        if not t or not ply:
+            return ply
+        return Ply(ply.card, *symmetries(game.board.size).move(t, ply.row, ply.column))
+
+    def from_table(self, ply, t, game):
+        if not t or not ply:
+            return ply
+        sym = symmetries(game.board.size)
+        return Ply(ply.card, *sym.move(sym.inverse[t], ply.row, ply.column))
+
+    # put the move the table remembers as best here (from a shallower search) first
+    def hinted(self, game, moves, key, t):
+        hint = self.from_table(self.tt.best_ply(key), t, game)
+        if hint:
+            code = self.movegen.table.code(hint.card.id & 15, hint.row, hint.column)
+            if code in moves:
+                moves.remove(code)
+                moves.insert(0, code)
+        return moves
+
+    # given a game state, all the plies the current player could make
+    def enum_plies(self, game):
+        return [self.code_ply(game, code) for code in self.movegen.moves(game)]
+
+    # the move codes from movegen, best first by how much they immediately add to the mover's board score
+    def ordered_moves(self, game, level=None):
+        board = game.board
+        player = game.players[game.p_turn]
+        before = board.score(player)
+        moves = self.movegen.moves(game, level)
+        scored = []
+        for code in moves:
+            ply = self.code_ply(game, code)
+            discard, error = board.update(ply)
+            scored.append((board.score(player) - before, code))
+            board.update(ply, True, discard)
+        scored.sort(key=lambda x: -x[0])
+        moves[:] = [code for delta, code in scored]
+        return moves
+
+    def ordered_plies(self, game):
+        return [self.code_ply(game, code) for code in self.ordered_moves(game)]
 
     # recursive search of future moves to the given depth
     def tree_search(self, game, depth):
+        if self.endgame is not None and self.endgame.applies(game):
+            return self.final_values(self.endgame.final_scores(game)), self.endgame.best_ply(game)
+        key, t = self.tt_key(game)
+        entry = self.tt.probe(key, depth)
+        if entry:
+            return entry.value, self.from_table(entry.ply, t, game)
+
+        search_depth = depth
         p_turn = game.p_turn
-        plies = self.enum_plies(game)
         best = ''
         bestply = ''
-        for ply in plies:
+        moves = self.hinted(game, self.movegen.moves(game, depth), key, t)
+        # the children are all leaves, at the search depth or the end of the game, so they're evaluated together
+        leaves = depth == 0 or not game.players[(p_turn + 1) % len(game.players)].hand
+        values = self.child_values(game, moves) if leaves else None
+        for k, code in enumerate(moves):
+            ply = self.code_ply(game, code)
+            if leaves:
+                node_value = values[k]
+            else:
+                game.make_move(ply)
+                self.count_node()
+                node_value = self.tree_search(game, depth - 1)[0]
+                game.unmake_move()
+
+            if best == '' or node_value[p_turn] > best[p_turn]:
+                best = node_value
+                bestply = ply
+
+        self.tt.store(key, search_depth, best, self.to_table(bestply, t, game))
+        return best, bestply
+
+    # max-n with shallow pruning. Values are win shares which sum to 1, so once this node's player is sure of
+    # `bound` the player choosing between this node and its siblings can't do better here, and the rest is skipped
+    def shallow_search(self, game, depth, bound):
+        key, t = self.tt_key(game)
+        entry = self.tt.probe(key, depth)
+        if entry:
+            return entry.value, self.from_table(entry.ply, t, game)
+
+        search_depth = depth
+        p_turn = game.p_turn
+        best = ''
+        bestply = ''
+        pruned = False
+        for code in self.hinted(game, self.ordered_moves(game, depth), key, t):
+            ply = self.code_ply(game, code)
             game.make_move(ply)
+            self.count_node()
             if game.gameover:
                 depth = 0
 
             if depth == 0:
-                node_value = self.heuristic_eval(game)
+                node_value = self.win_shares(self.heuristic_eval(game))
             else:
-                node_value = self.tree_search(game, depth - 1)[0]
+                node_value = self.shallow_search(game, depth - 1, 1 - (best[p_turn] if best else 0))[0]
 
             game.unmake_move()
             if best == '' or node_value[p_turn] > best[p_turn]:
                 best = node_value
                 bestply = ply
+            if best[p_turn] >= bound:
+                pruned = True
+                break
+
+        if not pruned:
+            self.tt.store(key, search_depth, best, self.to_table(bestply, t, game))
+        return best, bestply
+
+    # alpha-beta on the root player's value, with every other player minimising it
+    def paranoid_search(self, game, depth, alpha, beta, root):
+        key, t = self.tt_key(game)
+        entry = self.tt.probe(key, depth)
+        if entry:
+            if entry.flag == EXACT or \
+                    (entry.flag == LOWER and entry.value[root] >= beta) or \
+                    (entry.flag == UPPER and entry.value[root] <= alpha):
+                return entry.value, self.from_table(entry.ply, t, game)
+
+        search_depth = depth
+        alpha_start, beta_start = alpha, beta
+        maximising = game.p_turn == root
+        best = ''
+        bestply = ''
+        for code in self.hinted(game, self.ordered_moves(game, depth), key, t):
+            ply = self.code_ply(game, code)
+            game.make_move(ply)
+            self.count_node()
+            if game.gameover:
+                depth = 0
+
+            if depth == 0:
+                node_value = self.heuristic_eval(game)
+            else:
+                node_value = self.paranoid_search(game, depth - 1, alpha, beta, root)[0]
+
+            game.unmake_move()
+            if best == '' or (node_value[root] > best[root] if maximising else node_value[root] < best[root]):
+                best = node_value
+                bestply = ply
+            if maximising:
+                alpha = max(alpha, best[root])
+            else:
+                beta = min(beta, best[root])
+            if alpha >= beta:
+                break
 
+        if best[root] <= alpha_start:
+            flag = UPPER
+        elif best[root] >= beta_start:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.tt.store(key, search_depth, best, self.to_table(bestply, t, game), flag)
         return best, bestply
 
+    # turn heuristic values into shares of a single win, used where the search needs values with a fixed sum
+    def win_shares(self, values):
+        top = max(values)
+        weights = [math.exp((v - top) / self.temperature) for v in values]
+        total = sum(weights)
+        return [w / total for w in weights]
+
     # returns the value of the current game for each player in a three-item list
     # trying to take into account immediate future moves without doing a tree search
     # (so that this evaluation doesn't favour the player who just played)
     def heuristic_eval(self, game):
         if not game.gameover:
-            values = [0] * len(game.players)
-            for i, player in enumerate(game.players):
-                waittime = (i - game.p_turn) % len(game.players)  # plies until your next ply
-                score = player.score
-                boardscore = game.board.score(player) * (4 - waittime)  # how good the board is
-                # add some value for cards not currently in scoring positions
-                for row, x in enumerate(game.board._cards):
-                    for column, card in enumerate(x):
-                        if card != '' and card.suit == player.suit:
-                            if row in (2, 3, 4) or column in (2, 3, 4):
-                                boardscore += 0.5 * card.value
-                            else:
-                                boardscore += 0.2 * card.value
-
-                # point difference with the best player other than yourself
-                pointdiff = score - max([x.score for x in game.players if x.name != player.name])
-
-                hand_potential = sum([c.value for c in player.hand])
-                values[i] = pointdiff + 0.2 * boardscore + 0.5 * hand_potential
+            players = game.players
+            values = self.evaluate(game.board, players, [p.score for p in players], [p.hand_value for p in players],
+                                   game.p_turn)
         else:
-            maxscore = 0
-            winner_ids = []
-            for i, player in enumerate(game.players):
-                if player.score > maxscore:
-                    maxscore = player.score
-                    winner_ids = [i]
-                elif player.score == maxscore:
-                    winner_ids.append(i)
-            # losers have a large negative score
-            values = [-10000] * len(game.players)
-            # winner has a large positive score
-            # TODO: Should joint winners have lower score?
-            for i in winner_ids:
-                values[i] = 10000
+            values = self.final_values([p.score for p in game.players])
 
         return values
 
+    # the value of a finished game with these final scores
+    @staticmethod
+    def final_values(scores):
+        maxscore = 0
+        winner_ids = []
+        for i, score in enumerate(scores):
+            if score > maxscore:
+                maxscore = score
+                winner_ids = [i]
+            elif score == maxscore:
+                winner_ids.append(i)
+        # losers have a large negative score
+        values = [-10000] * len(scores)
+        # winner has a large positive score
+        # TODO: Should joint winners have lower score?
+        for i in winner_ids:
+            values[i] = 10000
+        return values
+
+    # heuristic_eval of a game in play, from the board's running sums and each player's score and hand value
+    def evaluate(self, board, players, scores, hand_values, p_turn):
+        n = len(players)
+        totals = board._totals
+        region = board._region
+        top = max(range(n), key=scores.__getitem__)
+        runner_up = max(s for i, s in enumerate(scores) if i != top)
+        values = [0] * n
+        for i, player in enumerate(players):
+            suit = suit_id(player.suit)
+            waittime = (i - p_turn) % n  # plies until your next ply
+            # how good the board is, plus some value for all your cards on it
+            boardscore = totals[suit] * (4 - waittime) + region[suit] / 10
+            # point difference with the best player other than yourself
+            pointdiff = scores[i] - (runner_up if i == top else scores[top])
+            values[i] = pointdiff + 0.2 * boardscore + 0.5 * hand_values[i]
+        return values
+
+    # heuristic_eval of the position after each of the moves, counting a node for each. Only the board is played
+    # on, with the score and hand the move changes adjusted around it, unless the moves end the game
+    def child_values(self, game, moves):
+        players = game.players
+        mover = game.p_turn
+        nxt = (mover + 1) % len(players)
+        values = []
+        if not players[nxt].hand:
+            for code in moves:
+                game.make_move(self.code_ply(game, code))
+                self.count_node()
+                values.append(self.heuristic_eval(game))
+                game.unmake_move()
+            return values
+
+        board = game.board
+        suit = suit_id(players[nxt].suit)
+        scores = [p.score for p in players]
+        hand_values = [p.hand_value for p in players]
+        score = scores[nxt]
+        hand_value = hand_values[mover]
+        for code in moves:
+            ply = self.code_ply(game, code)
+            self.count_node()  # before the board changes, as a timeout leaves the board as it is
+            discard, error = board.update(ply)
+            scores[nxt] = score + board._totals[suit]  # undo puts back a copy, so not held on to
+            hand_values[mover] = hand_value - ply.card.value
+            values.append(self.evaluate(board, players, scores, hand_values, nxt))
+            board.update(ply, True, discard)
+        return values
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+# Whether a stored value is exact or only a bound from an alpha-beta cutoff
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+
+# Process pool worker for AITreeSearch.parallel_search
+def _search_root_plies(snapshot, settings, depth, jobs):
+    game = Game(GameState.from_snapshot(snapshot), autostart=False, verbose=False)
+    player = game.players[game.p_turn]
+    searcher = AITreeSearch(player.name, player.suit)
+    searcher.mode, searcher.temperature, searcher.movegen.full_hand, searcher.endgame = settings
+    searcher.new_search(game)
+    results = []
+    alpha = -float('inf')
+    for i, code in jobs:
+        value = searcher.ply_value(game, searcher.code_ply(game, code), depth, alpha)
+        alpha = max(alpha, value[game.p_turn])
+        results.append((i, value))
+    return results, searcher.nodes
+
+
+class TTEntry:
+    __slots__ = ('key', 'depth', 'value', 'ply', 'flag', 'generation')
+
+    def __init__(self, key, depth, value, ply, flag, generation):
+        self.key = key
+        self.depth = depth
+        self.value = value  # value vector, one item per player
+        self.ply = ply
+        self.flag = flag
+        self.generation = generation
+
+
+# Fixed-size hash table of searched positions, keyed by Game.hash
+class TranspositionTable:
+    def __init__(self, size=2 ** 16):
+        self.size = size
+        self._slots = [None] * size
+        self.generation = 0  # bumped for every new root search
+        self.hits = 0
+        self.misses = 0
+
+    def new_search(self):
+        self.generation += 1
+
+    # best ply stored for a position at any depth, for move ordering
+    def best_ply(self, key):
+        entry = self._slots[key % self.size]
+        if entry is not None and entry.key == key:
+            return entry.ply
+        return None
+
+    def probe(self, key, depth):
+        entry = self._slots[key % self.size]
+        if entry is not None and entry.key == key and entry.depth >= depth:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, value, ply, flag=EXACT):
+        # Replace an entry from an older search, the same position, or a shallower search of another position.
+        # Deeper results from the current search are kept.
+        i = key % self.size
+        entry = self._slots[i]
+        if entry is None or entry.key == key or entry.generation != self.generation or depth >= entry.depth:
+            self._slots[i] = TTEntry(key, depth, value, ply, flag, self.generation)
+
+    def clear(self):
+        self._slots = [None] * self.size
+        self.hits = 0
+        self.misses = 0
+
+
+class MCTSNode:
+    __slots__ = ('move', 'parent', 'children', 'untried', 'visits', 'reward', 'p_turn', 'key')
+
+    def __init__(self, move, parent, game, moves):
+        self.move = move  # code of the move that led here
+        self.parent = parent
+        self.children = {}  # move code -> MCTSNode
+        self.untried = moves
+        self.visits = 0
+        self.reward = [0.0] * len(game.players)  # summed over playouts, one item per player
+        self.p_turn = game.p_turn  # who moves from here
+        self.key = game.hash
+
+
+# Monte Carlo tree search: UCT over a card of every value and every target, with random playouts to the end of the
+# game scored as a share of the win. Each player picks children by their own reward, as in max-n.
+class AIMCTSPlayer(Player):
+    def postinit(self):
+        self.AI = True
+        self.iterations = 1000  # playouts per move
+        self.time_limit = None  # seconds per move, used in place of iterations when set
+        self.exploration = 1.4
+        self.movegen = MoveGen()
+        self._plies = {}
+        self.tree = None  # the root searched last move, see reuse
+        self.nodes = 0  # playouts on the last move
+
+    new_search = AITreeSearch.new_search
+    code_ply = AITreeSearch.code_ply
+
+    def make_move(self, game_state, iterations=None, time_limit=None):
+        game = Game(game_state.fork(), autostart=False, verbose=False)
+        self.new_search(game)
+        root = self.reuse(game)
+        if iterations is None:
+            iterations = self.iterations
+        if time_limit is None:
+            time_limit = self.time_limit
+        deadline = time.perf_counter() + time_limit if time_limit is not None else float('inf')
+        self.nodes = 0
+        while (self.nodes < iterations if time_limit is None else time.perf_counter() < deadline) or \
+                not root.children:
+            self.iterate(game, root)
+            self.nodes += 1
+
+        self.tree = root
+        best = max(root.children.values(), key=lambda child: child.visits)
+        return self.code_ply(game, best.move)
+
+    # The node for this position from the last move's tree, found by hash a round of plies below its root, or a new
+    # root. It's only there if every other player's actual reply was expanded under the move made, and with dozens
+    # of moves a ply that takes far more playouts than the default: at 1000 a three player game rarely finds one,
+    # and then with a playout or so below it. Reuse pays off with much larger budgets or fewer players
+    def reuse(self, game):
+        if self.tree is not None:
+            level = [self.tree]
+            for _ in range(len(game.players)):
+                level = [child for node in level for child in node.children.values()]
+                for node in level:
+                    if node.key == game.hash:
+                        node.parent = None
+                        return node
+        return MCTSNode(None, None, game, self.movegen.distinct_moves(game))
+
+    def iterate(self, game, root):
+        node = root
+        made = 0
+        # down the tree by UCB while every move here has been tried
+        while not node.untried and node.children:
+            node = self.select(node)
+            game.make_move(self.code_ply(game, node.move))
+            made += 1
+        # try a new move
+        if node.untried:
+            move = node.untried.pop(random.randrange(len(node.untried)))
+            game.make_move(self.code_ply(game, move))
+            made += 1
+            child = MCTSNode(move, node, game, [] if game.gameover else self.movegen.distinct_moves(game))
+            node.children[move] = child
+            node = child
+        # then play randomly to the end
+        while not game.gameover:
+            self.random_move(game)
+            made += 1
+        reward = self.win_shares(game)
+        for _ in range(made):
+            game.unmake_move()
+        while node is not None:
+            node.visits += 1
+            for i, r in enumerate(reward):
+                node.reward[i] += r
+            node = node.parent
+
+    def select(self, node):
+        p = node.p_turn
+        log_n = math.log(node.visits)
+        c = self.exploration
+        return max(node.children.values(),
+                   key=lambda child: child.reward[p] / child.visits + c * math.sqrt(log_n / child.visits))
+
+    def random_move(self, game):
+        table = self.movegen.table
+        card = random.choice(game.players[game.p_turn].hand)
+        if game.board._empty:
+            target = random.choice(sorted(game.board._empty))
+        else:
+            target = random.choice(table.edges)
+        game.make_move(self.code_ply(game, (card.id & 15) * table.n + target))
+
+    @staticmethod
+    def win_shares(game):
+        top = max(p.score for p in game.players)
+        winners = [p.score == top for p in game.players]
+        return [w / sum(winners) for w in winners]
+
 
 # the information which players are sent to make their move
 class GameState:
@@ -437,6 +1108,37 @@ class GameState:
     def __repr__(self):
         return repr(self.board) + "\n\n" + self.statement()
 
+    def fork(self):
+        """An independent copy of the position for a search to play on: a copy of the board and plain copies of the
+        players, with no history"""
+        return GameState(self.board.copy(), [p.copy() for p in self.players], [], self.p_turn, self.gameover)
+
+    def snapshot(self):
+        # Plain tuples of ints and strings describing the position, cheap to send to another process.
+        # Card ids depend on the order suits were first seen, so the suit table goes along with them.
+        return (tuple(SUITS), self.board.size, tuple(self.board._cells), self.board._final, self.p_turn,
+                self.gameover, tuple((p.name, p.suit, p.score, tuple(c.id for c in p.hand)) for p in self.players))
+
+    @staticmethod
+    def from_snapshot(snapshot):
+        suits, size, cells, final, p_turn, gameover, players = snapshot
+        suit_map = [suit_id(suit) for suit in suits]
+
+        def local(cid):
+            return suit_map[cid >> 4] << 4 | cid & 15 if cid else 0
+
+        board = Board(size, empty=[])
+        board.set_cells([local(c) for c in cells])
+        if final:
+            board.finalise()
+        new_players = []
+        for name, suit, score, hand in players:
+            player = Player(name, suit)
+            player.score = score
+            player.hand = [card_from_id(local(c)) for c in hand]
+            new_players.append(player)
+        return GameState(board, new_players, [], p_turn, gameover)
+
 
 class StartGameState(GameState):
     def __init__(self, board, players):
@@ -444,36 +1146,59 @@ class StartGameState(GameState):
 
 
 class Game:
-    def __init__(self, game_state, fname='', save=1, load=1, autostart=True):
+    def __init__(self, game_state, fname='', save=1, load=1, autostart=True, journal=0, verbose=None):
+        self.verbose = PRINT if verbose is None else verbose  # print the game as it goes
+        # With journal set, saving appends each ply to fname + '.log' and only rewrites fname every journal plies.
+        # Every record is fsynced, so a ply that has been made survives a power cut as well as a crash
+        self.journal = journal
+        self._seq = 0  # changes saved since the game started, undos included
+        self._log = None
+        self._since_snapshot = 0
         if fname != '':
             self.fname = fname
             self.save = save
+            loaded = False
             if load:
                 try:
-                    game_state = self.load()
+                    game_state = self.load(game_state)
+                    loaded = True
                 except FileNotFoundError:
-                    print('No file {} found. Using input GameState')
+                    if self.verbose:
+                        print('No file {} found. Using input GameState'.format(fname))
         else:
             self.save = 0
             self.fname = 'err.pi'
+            loaded = False
 
         self.board = game_state.board
         self.players = game_state.players
-        self.plyhistory = game_state.plyhistory
         self.p_turn = game_state.p_turn
         self.gameover = game_state.gameover
 
-        self.plyhistory = []
+        # A loaded history is our own; anything else may be the list of a game we're searching from
+        self.plyhistory = game_state.plyhistory if loaded else []
+
+        # Zobrist hash of the hands, scores and turn; the board keeps the hash of its own cells
+        self._hash = ZOBRIST['turn', self.p_turn]
+        for i, player in enumerate(self.players):
+            self._hash ^= ZOBRIST['score', i, player.score]
+            for card in player.hand:
+                self._hash ^= ZOBRIST['hand', i, card.id]
 
+        if loaded and self.journal:
+            self.replay()
         if self.save:
-            self.dump()
+            if self.journal:
+                self.snapshot()
+            else:
+                self.dump()
 
         if autostart:
             self.gameloop()
 
     def gameloop(self):
         while not self.gameover:
-            if PRINT:
+            if self.verbose:
                 print('\n'.join('{}: {}'.format(player, player.score) for player in self.players))
                 print(self.get_game_state())
             self.turn()
@@ -492,33 +1217,48 @@ class Game:
             else:
                 break
 
-        if PRINT:
+        if self.verbose:
             print(ply)
 
         error = self.make_move(ply)
         return error
 
+    @property
+    def hash(self):
+        return self.board.hash ^ self._hash
+
+    def alter_score(self, i, delta):
+        player = self.players[i]
+        self._hash ^= ZOBRIST['score', i, player.score]
+        player.alter_score(delta)
+        self._hash ^= ZOBRIST['score', i, player.score]
+
     def make_move(self, ply):
         player = self.players[self.p_turn]
         discard, error = self.board.update(ply)
         
         self.plyhistory.append((ply, discard))
         if discard:
-            player.play(ply.card)
+            card = player.in_hand(ply.card)
+            player.play(card)
+            self._hash ^= ZOBRIST['hand', self.p_turn, card.id]
 
+            self._hash ^= ZOBRIST['turn', self.p_turn]
             self.p_turn = (self.p_turn + 1) % len(self.players)
+            self._hash ^= ZOBRIST['turn', self.p_turn]
 
             next_player = self.players[self.p_turn]
 
             if not next_player.hand:
                 self.final()
             else:
-                next_player.alter_score(self.board.score(next_player))
+                self.alter_score(self.p_turn, self.board.score(next_player))
 
-            if self.save:
-                self.dump()
+            self.persist(JOURNAL_MOVE)
             return 'Done'
         
+        if self.verbose:
+            print(error)
         raise Exception('Invalid value for discard during make_move, board: \n{}'.format(repr(self.board)))
         return error
 
@@ -529,54 +1269,278 @@ class Game:
         if self.gameover:
             self.unfinal()
         else:
-            player.alter_score(-self.board.score(player))
+            self.alter_score(self.p_turn, -self.board.score(player))
 
+        self._hash ^= ZOBRIST['turn', self.p_turn]
         self.p_turn = (self.p_turn - 1) % len(self.players)
+        self._hash ^= ZOBRIST['turn', self.p_turn]
         lastplayer = self.players[self.p_turn]
 
         self.board.update(unply, True, undiscard)
         lastplayer.unplay(unply.card)
-        
-        if self.save:
-            self.dump()
+        self._hash ^= ZOBRIST['hand', self.p_turn, unply.card.id]
+
+        self.persist(JOURNAL_UNDO)
         return True
 
     def final(self):
         self.gameover = True
-        if PRINT:
+        if self.verbose:
             print('\n'.join('{}: {}'.format(player, player.score) for player in self.players))
-        for player in self.players:
+        for i, player in enumerate(self.players):
             score = self.board.score(player)
-            player.alter_score(score)
+            self.alter_score(i, score)
 
         self.board.finalise()
-        if PRINT:
+        if self.verbose:
             print('Final score:')
             print('\n'.join('{}: {}'.format(player, player.score) for player in self.players))
-        if self.save:
-            self.dump()
         return self.get_game_state().statement()
 
     def unfinal(self):
         self.gameover = False
         self.board.unfinalise()
-        for player in self.players:
+        for i, player in enumerate(self.players):
             score = self.board.score(player)
-            player.alter_score(-score)
-        if self.save:
-            self.dump()
+            self.alter_score(i, -score)
         return True
 
     def get_game_state(self):
         return GameState(self.board, self.players, self.plyhistory, self.p_turn, self.gameover)
 
+    def fork(self):
+        # a game on a copy of this position that doesn't save or print
+        return Game(self.get_game_state().fork(), autostart=False, verbose=False)
+
     def dump(self):
         with open(self.fname, 'wb') as f:
-            pickle.dump(self.get_game_state(), f)
+            f.write(pack_game(self.get_game_state(), self._seq))
 
-    def load(self):
+    def load(self, game_state=None):
+        # the file holds no names or player types, so it's loaded into the players of the given game state, by
+        # default this game's. Saves from before the binary format are pickled game states, see unpickle_game
+        if game_state is None:
+            game_state = self.get_game_state()
         with open(self.fname, 'rb') as f:
-            return pickle.load(f)
+            data = f.read()
+        if not data.startswith(SAVE_MAGIC):
+            self._seq = 0
+            return unpickle_game(data, game_state.players)
+        self._seq = save_seq(data)
+        return unpack_game(data, game_state.players)
+
+    # save the move or undo just made
+    def persist(self, op):
+        if not self.save:
+            return
+        if not self.journal:
+            self.dump()
+            return
+        self._seq += 1
+        if op == JOURNAL_MOVE:
+            code = card_codes(self.players)
+            ply, discard = self.plyhistory[-1]
+            record = _JOURNAL_RECORD.pack(self._seq, op, code(ply.card.id), ply.row << 4 | ply.column,
+                                          code(discard.id) if discard != 'Insert' else 0)
+        else:
+            record = _JOURNAL_RECORD.pack(self._seq, op, 0, 0, 0)
+        self._log.write(record)
+        os.fsync(self._log.fileno())
+        self._since_snapshot += 1
+        if self._since_snapshot >= self.journal:
+            self.snapshot()
+
+    # Write the whole game next to the save file, swap it in, then start an empty log. A crash before the log is
+    # emptied leaves records the snapshot already has, which replay skips by their sequence numbers. The directory
+    # is synced after the swap so the log can't be emptied on disk before the snapshot is in place
+    def snapshot(self):
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(pack_game(self.get_game_state(), self._seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.fname)
+        fsync_dir(self.fname)
+        if self._log:
+            self._log.close()
+        self._log = open(self.fname + '.log', 'wb', buffering=0)
+        fsync_dir(self.fname)  # for a new log
+        self._since_snapshot = 0
+
+    # apply the logged moves and undos that came after the loaded snapshot. A torn last record is dropped
+    def replay(self):
+        try:
+            with open(self.fname + '.log', 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        card_id = card_ids(self.players)
+        code = card_codes(self.players)
+        save = self.save
+        self.save = 0
+        for pos in range(0, len(data) - _JOURNAL_RECORD.size + 1, _JOURNAL_RECORD.size):
+            seq, op, card, rowcol, discard = _JOURNAL_RECORD.unpack_from(data, pos)
+            if seq <= self._seq:
+                continue
+            if seq != self._seq + 1:
+                raise Exception('Missing journal records {} to {} in {}.log'.format(self._seq + 1, seq - 1, self.fname))
+            if op == JOURNAL_UNDO:
+                self.unmake_move()
+            else:
+                card = self.players[self.p_turn].in_hand(card_from_id(card_id(card)).name)
+                self.make_move(Ply(card, rowcol >> 4, rowcol & 15))
+                made = self.plyhistory[-1][1]
+                if (code(made.id) if made != 'Insert' else 0) != discard:
+                    raise Exception('Journal record {} in {}.log does not match the game'.format(seq, self.fname))
+            self._seq = seq
+        self.save = save
+
+    def close(self):
+        if self._log:
+            self._log.close()
+            self._log = None
+
+
+# Binary save format: a 4 byte header (b'CRL' and the version) then
+#   number of players, board size, p_turn, flags (1 game over, 2 board finalised)   4 x uint8
+#   journal sequence number (from version 2)                                        uint32
+#   cells                                                                           size * size bytes
+#   per player: hand as a bitmask of ranks, score                                   uint16, int32
+#   number of plies, then per ply: card, row << 4 | column, discarded card          uint16, 3 bytes each
+# Card bytes hold the rank in the low four bits and 1 + the index of the player whose suit it is in the high bits
+# (0 for the blanks and the joker), so files don't depend on this process's suit ids. 0 is an empty cell, or no card
+# discarded by an insert.
+# Journal records are the sequence number, JOURNAL_MOVE or JOURNAL_UNDO, then for a move the same 3 bytes as a ply.
+SAVE_MAGIC = b'CRL'
+SAVE_VERSION = 2
+_SAVE_VERSION = struct.Struct('<3sB')
+_SAVE_HEADERS = {1: struct.Struct('<3s5B'), 2: struct.Struct('<3s5BI')}
+_SAVE_PLAYER = struct.Struct('<Hi')
+_SAVE_COUNT = struct.Struct('<H')
+_JOURNAL_RECORD = struct.Struct('<I4B')
+JOURNAL_MOVE = 1
+JOURNAL_UNDO = 2
+HAND_RANKS = [13, 12, 11] + list(range(1, 11))  # the order Player deals a hand: K, Q, J, A, 2 ... 10
+
+
+def card_codes(players):
+    # function from card id to save file byte for a game between these players
+    slots = {suit_id(p.suit): i + 1 for i, p in enumerate(players)}
+
+    def code(cid):
+        return slots.get(cid >> 4, 0) << 4 | cid & 15 if cid else 0
+    return code
+
+
+def card_ids(players):
+    # the reverse of card_codes
+    suits = [suit_id(p.suit) for p in players]
+
+    def card_id(code):
+        if not code:
+            return 0
+        if code >> 4:
+            return suits[(code >> 4) - 1] << 4 | code & 15
+        return suit_id('*' if code & 15 == RANKS['*'] else '') << 4 | code & 15
+    return card_id
+
+
+def pack_game(game_state, seq=0):
+    players = game_state.players
+    board = game_state.board
+    code = card_codes(players)
+    flags = (1 if game_state.gameover else 0) | (2 if board._final else 0)
+    out = bytearray(_SAVE_HEADERS[SAVE_VERSION].pack(SAVE_MAGIC, SAVE_VERSION, len(players), board.size,
+                                                     game_state.p_turn, flags, seq))
+    out += bytes(code(c) for c in board._cells)
+    for p in players:
+        out += _SAVE_PLAYER.pack(sum(1 << (c.id & 15) - 1 for c in p.hand), p.score)
+    out += _SAVE_COUNT.pack(len(game_state.plyhistory))
+    for ply, discard in game_state.plyhistory:
+        out += bytes((code(ply.card.id), ply.row << 4 | ply.column, code(discard.id) if discard != 'Insert' else 0))
+    return bytes(out)
+
+
+def _save_header(data):
+    magic, version = _SAVE_VERSION.unpack_from(data)
+    if magic != SAVE_MAGIC:
+        raise Exception('Not a curling save file')
+    if version not in _SAVE_HEADERS:
+        raise Exception('Unsupported save file version {}'.format(version))
+    header = _SAVE_HEADERS[version].unpack_from(data)
+    return header[2:] + (0,) * (version == 1), _SAVE_HEADERS[version].size
+
+
+def fsync_dir(fname):
+    # make renames and new files in fname's directory durable, where directories can be opened (not on Windows)
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(fname)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def save_seq(data):
+    return _save_header(data)[0][4]
+
+
+def unpack_game(data, players):
+    (n_players, size, p_turn, flags, seq), pos = _save_header(data)
+    if n_players != len(players):
+        raise Exception('Save file is for {} players, not {}'.format(n_players, len(players)))
+    card_id = card_ids(players)
+
+    board = Board(size, empty=[])
+    board.set_cells([card_id(c) for c in data[pos:pos + size * size]])
+    if flags & 2:
+        board.finalise()
+    pos += size * size
+    for player in players:
+        mask, player.score = _SAVE_PLAYER.unpack_from(data, pos)
+        pos += _SAVE_PLAYER.size
+        player.hand = [Card(RANK_NAMES[r], player.suit) for r in HAND_RANKS if mask >> r - 1 & 1]
+    count, = _SAVE_COUNT.unpack_from(data, pos)
+    pos += _SAVE_COUNT.size
+    plyhistory = []
+    for _ in range(count):
+        card, rowcol, discard = data[pos:pos + 3]
+        pos += 3
+        plyhistory.append((Ply(card_from_id(card_id(card)), rowcol >> 4, rowcol & 15),
+                           card_from_id(card_id(discard)) if discard else 'Insert'))
+    return GameState(board, players, plyhistory, p_turn, bool(flags & 1))
+
+
+class _Saved:
+    # an object of this module's from a pickled save, with the attributes it had then
+    pass
+
+
+class _SaveUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module in ('curling2', '__main__'):
+            return _Saved
+        return super().find_class(module, name)
+
+
+def unpickle_game(data, players):
+    """A save from before the binary format, which pickled the whole GameState, players' AIs and all. Only the
+    position is taken, into players as unpack_game does. The ply history was never loaded from these"""
+    saved = _SaveUnpickler(io.BytesIO(data)).load()
+    if len(saved.players) != len(players):
+        raise Exception('Save file is for {} players, not {}'.format(len(saved.players), len(players)))
+    board = Board(saved.board.size, empty=[])
+    board.set_cells([Card(c.name, c.suit).id if c else 0 for row in saved.board._cards for c in row])
+    if saved.board._final:
+        board.finalise()
+    for player, old in zip(players, saved.players):
+        player.score = old.score
+        player.hand = [Card(c.name, player.suit) for c in old.hand]
+    return GameState(board, players, [], saved.p_turn, saved.gameover)
 
 
 #
@@ -588,48 +1552,22 @@ class Game:
 #
 
 
-def main(fname='curling.pi'):
+def main(fname='curling.pi', verbose=None):
     board = Board()
     players = [AITreeSearch('Matt', chr(9829)),
                AIPlayer('F. Rob', chr(9830)),
                AITreeSearch('Rob H.', chr(9827))]
     game_state = StartGameState(board, players)
-    game = Game(game_state, fname=fname, save=0, load=0)
+    game = Game(game_state, fname=fname, save=0, load=0, verbose=verbose)
+    return [p.score for p in game.players]
 
 
-def averages(runs):
-    global PRINT
-    PRINT = False
-    results = []
-    runs = 10000
-    for _ in range(runs):
-        results.append(main())
-
-    end = [0, 0, 0]
-    diff = [0, 0, 0]
-    av_m = []
-    for a, b, c in results:
-        m = max(a, b, c)
-        if a == m:
-            end[0] += 1
-        if b == m:
-            end[1] += 1
-        if c == m:
-            end[2] += 1
-
-        diff[0] += a - b
-        diff[1] += b - c
-        diff[2] += c - a
-        av_m.append(m)
-
-    print(end)
-    for i in range(3):
-        diff[i] /= runs
-    for i in range(len(results[0])):
-        print(sum(x[i] for x in results) / runs)
-
-    print(diff)
-    print(sum(av_m) / runs)
+def quiet_main():
+    return main(verbose=False)
+
+
+def averages(runs, workers=None, seed=None):
+    play_games(quiet_main, runs, workers, seed).report()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,113 @@
+"""Exact play for the last plies of a curling2 game.
+
+Once few enough cards are left in hand, the rest of the game is searched in full, a card of every value in hand to
+every edge (cards of equal value play the same), by max-n on the final result: each player takes the move that wins
+(AITreeSearch.final_values of the final scores), and among equally good ones the one that gets them the most
+points, the first of equal ones in hand order. Which moves win depends on the board, the hands, whose turn it is and
+the differences between the scores, not on the scores themselves, so solved positions are kept under that key with
+the points still to come, and reused by later moves and later games.
+
+    ai.endgame = EndgameSolver()  # for an AITreeSearch ai"""
+from cards import RANK_NAMES, Card, suit_id
+from curling2 import AITreeSearch, Ply
+from movegen import MoveGen
+
+
+class EndgameSolver:
+    def __init__(self, threshold=3, capacity=1 << 20):
+        self.threshold = threshold  # most plies left to solve
+        self.capacity = capacity  # positions kept, the table is emptied when it fills up
+        self.table = {}  # position key -> (points to come for each player, best move code)
+        self.movegen = MoveGen()
+        self._plies = {}  # (move code, suit) -> Ply
+        self.nodes = 0
+        self.hits = 0
+
+    def __getstate__(self):
+        # the table stays behind when the solver is sent to a worker process
+        state = self.__dict__.copy()
+        state['table'] = {}
+        return state
+
+    def applies(self, game):
+        return not game.gameover and not game.board._empty and \
+            sum(len(p.hand) for p in game.players) <= self.threshold
+
+    @staticmethod
+    def key(game):
+        # card ids fit in a byte while fewer than 16 suits have been seen
+        low = min(p.score for p in game.players)
+        return bytes(game.board._cells), tuple(p.mask << 8 | suit_id(p.suit) for p in game.players), game.p_turn, \
+            tuple(p.score - low for p in game.players)
+
+    @staticmethod
+    def rank(scores, gains, p):
+        # how good the game ending on scores + gains is for player p: winning first, then their points
+        final = [s + g for s, g in zip(scores, gains)]
+        return AITreeSearch.final_values(final)[p], final[p]
+
+    def solve(self, game):
+        """(gains, code): the points each player gets from here to the end with best play, and the move (see
+        movegen) the player to move should make"""
+        key = self.key(game)
+        solved = self.table.get(key)
+        if solved is not None:
+            self.hits += 1
+            return solved
+
+        players = game.players
+        p_turn = game.p_turn
+        board = game.board
+        self.movegen.reset(board.size)
+        scores = [p.score for p in players]
+        best = None
+        best_rank = None
+        if not players[(p_turn + 1) % len(players)].hand:
+            # every move ends the game, which scores the board for everyone, so the moves are only scored
+            table = self.movegen.table
+            suits = [suit_id(p.suit) for p in players]
+            targets = sorted(board._empty) if board._empty else table.edges
+            cells = [table.targets[t] for t in targets]
+            seen = 0
+            for card in players[p_turn].hand:
+                if seen >> card.value & 1:
+                    continue
+                seen |= 1 << card.value
+                for target, gains in zip(targets, board.test_moves(card, cells, suits)):
+                    self.nodes += 1
+                    rank = self.rank(scores, gains, p_turn)
+                    if best is None or rank > best_rank:
+                        best = (gains, (card.id & 15) * table.n + target)
+                        best_rank = rank
+        else:
+            for code in self.movegen.distinct_moves(game):
+                game.make_move(self.ply(game, code))
+                self.nodes += 1
+                gains = [p.score - s for p, s in zip(players, scores)]
+                gains = [g + rest for g, rest in zip(gains, self.solve(game)[0])]
+                game.unmake_move()
+                rank = self.rank(scores, gains, p_turn)
+                if best is None or rank > best_rank:
+                    best = (gains, code)
+                    best_rank = rank
+
+        if len(self.table) >= self.capacity:
+            self.table.clear()
+        self.table[key] = best
+        return best
+
+    def final_scores(self, game):
+        gains, code = self.solve(game)
+        return [p.score + g for p, g in zip(game.players, gains)]
+
+    def best_ply(self, game):
+        gains, code = self.solve(game)
+        return self.ply(game, code)
+
+    def ply(self, game, code):
+        suit = game.players[game.p_turn].suit
+        ply = self._plies.get((code, suit))
+        if ply is None:
+            rank, row, column = self.movegen.table.decode(code)
+            ply = self._plies[code, suit] = Ply(Card(RANK_NAMES[rank], suit), row, column)
+        return ply
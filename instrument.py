@@ -0,0 +1,150 @@
+"""Opt-in counters and timers for the games and the AIs.
+
+A Profiler wraps the hot methods of the game classes while it is attached and puts the classes back as they were
+when it is detached, so nothing is paid for it otherwise. It counts calls and their time (inclusive of what they
+call) for the board and game methods, the latency and nodes searched of every AI move, and the moves generated per
+search depth, the branching factor.
+
+    with Profiler() as prof:
+        curling2.main(verbose=False)
+    prof.save('profile.json')"""
+import functools
+import json
+import time
+
+import curling
+import curling2
+import movegen
+
+TIMED = [(curling2.Board, 'update'), (curling2.Board, 'score'), (curling2.Board, 'get_empty'),
+         (curling2.Game, 'make_move'), (curling2.Game, 'unmake_move'), (curling2.AITreeSearch, 'heuristic_eval'),
+         (curling.Board, 'update'), (curling.Board, 'score'), (curling.Board, 'get_empty'),
+         (curling.Board, 'test_moves')]
+PLAYERS = [curling2.AIPlayer, curling2.AITreeSearch, curling2.AIMCTSPlayer]
+AI_TURNS = ['random_ai_turn', 'one_set_ai']  # curling.py's AIs are functions
+
+
+class Profiler:
+    def __init__(self, timed=None, players=None):
+        self.timed = timed if timed is not None else TIMED
+        self.players = players if players is not None else PLAYERS
+        self.calls = {}  # name -> [calls, ns]
+        self.moves = {}  # player class name -> [moves, ns, max ns, nodes]
+        self.branching = {}  # depth left, 'root' or 'all' -> [lists, moves]
+        self._patched = []  # (owner, attribute, original or None if inherited)
+
+    def __enter__(self):
+        self.attach()
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def _patch(self, owner, name, wrapper):
+        own = owner.__dict__.get(name) if isinstance(owner, type) else getattr(owner, name)
+        self._patched.append((owner, name, own))
+        setattr(owner, name, wrapper(getattr(owner, name)))
+
+    def attach(self):
+        if self._patched:
+            raise Exception('Profiler already attached')
+        for cls, name in self.timed:
+            key = '{}.{}.{}'.format(cls.__module__, cls.__name__, name)
+            self._patch(cls, name, lambda f, key=key: self._timer(f, key))
+        for cls in self.players:
+            self._patch(cls, 'make_move', lambda f, key=cls.__name__: self._move_timer(f, key))
+        for name in AI_TURNS:
+            self._patch(curling, name, lambda f, key=name: self._move_timer(f, key))
+        self._patch(movegen.MoveGen, 'moves', self._counter)
+        self._patch(movegen.MoveGen, 'all_moves', lambda f: self._counter(f, 'all'))
+
+    def detach(self):
+        while self._patched:
+            owner, name, original = self._patched.pop()
+            if original is None:
+                delattr(owner, name)  # was inherited
+            else:
+                setattr(owner, name, original)
+
+    def reset(self):
+        # in place, the wrappers hold on to the lists
+        for stats in (self.calls, self.moves, self.branching):
+            for stat in stats.values():
+                stat[:] = [0] * len(stat)
+
+    def _timer(self, f, key):
+        stat = self.calls.setdefault(key, [0, 0])
+        clock = time.perf_counter_ns
+
+        @functools.wraps(f)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                stat[0] += 1
+                stat[1] += clock() - start
+        return timed
+
+    def _move_timer(self, f, key):
+        stat = self.moves.setdefault(key, [0, 0, 0, 0])
+        clock = time.perf_counter_ns
+
+        @functools.wraps(f)
+        def timed(player, *args, **kwargs):
+            start = clock()
+            result = f(player, *args, **kwargs)
+            ns = clock() - start
+            stat[0] += 1
+            stat[1] += ns
+            stat[2] = max(stat[2], ns)
+            stat[3] += getattr(player, 'nodes', 0)
+            return result
+        return timed
+
+    def _counter(self, f, key=None):
+        # moves per list, keyed by the search's depth left (or 'root' without one), or by key if given
+        branching = self.branching
+
+        @functools.wraps(f)
+        def counted(movegen, game, *level):
+            moves = f(movegen, game, *level)
+            k = key if key is not None else level[0] if level and level[0] is not None else 'root'
+            stat = branching.get(k)
+            if stat is None:
+                stat = branching[k] = [0, 0]
+            stat[0] += 1
+            stat[1] += len(moves)
+            return moves
+        return counted
+
+    def report(self):
+        calls = {key: {'calls': n, 'total_ms': ns / 1e6, 'mean_us': ns / n / 1e3 if n else 0}
+                 for key, (n, ns) in self.calls.items() if n}
+        moves = {key: {'moves': n, 'total_ms': ns / 1e6, 'mean_ms': ns / n / 1e6, 'max_ms': top / 1e6,
+                       'nodes': nodes, 'nodes_per_move': nodes / n}
+                 for key, (n, ns, top, nodes) in self.moves.items() if n}
+        branching = {str(key): {'lists': n, 'moves': m, 'mean': m / n} for key, (n, m) in self.branching.items()}
+        return {'calls': calls, 'moves': moves, 'branching': branching}
+
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+
+    def __str__(self):
+        report = self.report()
+        lines = ['{:<40}{:>10}{:>12}{:>10}'.format('call', 'calls', 'total ms', 'mean us')]
+        for key, s in sorted(report['calls'].items(), key=lambda kv: -kv[1]['total_ms']):
+            lines.append('{:<40}{:>10}{:>12.1f}{:>10.2f}'.format(key, s['calls'], s['total_ms'], s['mean_us']))
+        for key, s in report['moves'].items():
+            lines.append('{}: {} moves, {:.2f} ms mean, {:.2f} ms max, {:.0f} nodes per move'.format(
+                key, s['moves'], s['mean_ms'], s['max_ms'], s['nodes_per_move']))
+        for key, s in report['branching'].items():
+            lines.append('branching at {}: {:.1f}'.format(key, s['mean']))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    with Profiler() as prof:
+        curling2.main(verbose=False)
+    print(prof)
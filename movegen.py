@@ -0,0 +1,113 @@
+"""Move tables and move generation shared by the AIs.
+
+A move is a small int, rank * table.n + target. rank is the card's rank (its id & 15, see cards.RANKS), which picks
+out one card of the mover's hand whatever its suit, and target indexes table.targets: the size * size cells (by cell
+index) a card can be inserted into during setup, then the 4 * size edge moves."""
+
+
+class MoveTable:
+    def __init__(self, size):
+        self.size = size
+        cells = [(r, c) for r in range(1, size + 1) for c in range(1, size + 1)]
+        # edge moves in the order the AIs have always tried them: top, bottom, left, right
+        edges = [(0, i) for i in range(1, size + 1)] + [(size + 1, i) for i in range(1, size + 1)] + \
+                [(i, 0) for i in range(1, size + 1)] + [(i, size + 1) for i in range(1, size + 1)]
+        self.targets = cells + edges  # target -> (row, column)
+        self.n = len(self.targets)
+        self.edges = tuple(range(size * size, self.n))
+        self.index = {rowcol: i for i, rowcol in enumerate(self.targets)}
+
+    def code(self, rank, row, column):
+        return rank * self.n + self.index[row, column]
+
+    def decode(self, code):
+        # (rank, row, column)
+        rank, target = divmod(code, self.n)
+        return (rank,) + self.targets[target]
+
+
+_tables = {}
+
+
+def move_table(size):
+    table = _tables.get(size)
+    if table is None:
+        table = _tables[size] = MoveTable(size)
+    return table
+
+
+_bounded = {}
+
+
+def bounded_cells(size, lo, hi):
+    """Sets of the (row, column) cells with the row, the column, and both between lo and hi"""
+    key = (size, lo, hi)
+    if key not in _bounded:
+        cells = move_table(size).targets[:size * size]
+        _bounded[key] = ({(r, c) for r, c in cells if lo <= r <= hi},
+                         {(r, c) for r, c in cells if lo <= c <= hi},
+                         {(r, c) for r, c in cells if lo <= r <= hi and lo <= c <= hi})
+    return _bounded[key]
+
+
+class MoveGen:
+    """The moves AITreeSearch considers: its highest value card then its lowest, each to every empty cell or every
+    edge, or with full_hand set one card of every value. A search asks for one list per depth and the lists are
+    refilled rather than reallocated"""
+    def __init__(self, size=5, full_hand=False):
+        self.table = move_table(size)
+        self.full_hand = full_hand
+        self._buffers = {}
+
+    def reset(self, size):
+        self.table = move_table(size)
+
+    def _buffer(self, level):
+        if level is None:
+            return []
+        out = self._buffers.get(level)
+        if out is None:
+            out = self._buffers[level] = []
+        out.clear()
+        return out
+
+    def moves(self, game, level=None):
+        """Codes of the moves for the player to move, in a new list, or with a level in that level's list"""
+        if self.full_hand:
+            return self.distinct_moves(game, level)
+        table = self.table
+        out = self._buffer(level)
+
+        hand = game.players[game.p_turn].hand
+        # first of the highest values in hand order, last of the lowest
+        high = low = hand[0]
+        for card in hand:
+            if card.value > high.value:
+                high = card
+            if card.value <= low.value:
+                low = card
+        targets = sorted(game.board._empty) if game.board._empty else table.edges
+        out.extend(map(((high.id & 15) * table.n).__add__, targets))
+        if len(hand) > 1:
+            out.extend(map(((low.id & 15) * table.n).__add__, targets))
+        return out
+
+    def distinct_moves(self, game, level=None):
+        """Codes of the moves of one card of each value in hand, the first of equal ones in hand order, to every
+        target. Cards only score and shift by value, so K, Q, J and 10 of a suit are the same move and this is every
+        real choice for a fraction of all_moves"""
+        table = self.table
+        out = self._buffer(level)
+        targets = sorted(game.board._empty) if game.board._empty else table.edges
+        seen = 0
+        for card in game.players[game.p_turn].hand:
+            if not seen >> card.value & 1:
+                seen |= 1 << card.value
+                out.extend(map(((card.id & 15) * table.n).__add__, targets))
+        return out
+
+    def all_moves(self, game):
+        """Codes of every move for the player to move: each card in hand order, to every target"""
+        targets = sorted(game.board._empty) if game.board._empty else self.table.edges
+        n = self.table.n
+        return [(card.id & 15) * n + target for card in game.players[game.p_turn].hand for target in targets]
@@ -0,0 +1,102 @@
+"""Opening book for the setup phase, when the cards go into the empty cells.
+
+Positions are keyed by the cells and hands seen from the player to move: seats are renumbered from the mover, so the
+book doesn't depend on the suits or on which seat is moving, and the board is turned to its canonical orientation (see
+symmetry), so one entry covers all 8 rotations and reflections. The book is built offline by playing AITreeSearch
+games and keeping the move its search picks for every setup position reached, then loaded into
+AITreeSearch.book or curling.BOOK, which look the position up before searching.
+
+    python openings.py [games] [depth] [file]"""
+import json
+import math
+import random
+import sys
+
+import curling2
+from cards import suit_id
+from symmetry import canonical_cells, symmetries
+
+
+def position_key(cells, players, p_turn):
+    """(key, t) for cells of card ids (0 for an empty cell) in row major order. The key is for the position turned to
+    its canonical orientation, and t is the symmetry transform that does it"""
+    n = len(players)
+    seats = [players[(p_turn + i) % n] for i in range(n)]
+    slots = {suit_id(p.suit): i + 1 for i, p in enumerate(seats)}
+    t, codes = canonical_cells(cells, math.isqrt(len(cells)), lambda c: slots.get(c >> 4, 0) << 4 | c & 15 if c else 0)
+    key = bytes(codes)
+    for p in seats:
+        mask = 0
+        for card in p.hand:
+            mask |= 1 << (card.id & 15)
+        key += mask.to_bytes(2, 'little')
+    return key.hex(), t
+
+
+class OpeningBook:
+    def __init__(self, moves=None):
+        self.moves = moves if moves is not None else {}  # position key -> [rank, row, column], canonical orientation
+
+    def lookup(self, cells, players, p_turn):
+        """(rank, row, column) of the book move, or None"""
+        key, t = position_key(cells, players, p_turn)
+        move = self.moves.get(key)
+        if move:
+            rank, row, column = move
+            sym = symmetries(math.isqrt(len(cells)))
+            return (rank,) + sym.move(sym.inverse[t], row, column)
+
+    def ply(self, game_state):
+        # for curling2 players
+        move = self.lookup(game_state.board._cells, game_state.players, game_state.p_turn)
+        if move:
+            rank, row, column = move
+            return curling2.Ply(curling2.Card(curling2.RANK_NAMES[rank], game_state.next_player.suit), row, column)
+
+    def add(self, game, ply):
+        key, t = position_key(game.board._cells, game.players, game.p_turn)
+        self.moves[key] = [ply.card.id & 15] + list(symmetries(game.board.size).move(t, ply.row, ply.column))
+
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.moves, f, sort_keys=True)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname) as f:
+            return cls(json.load(f))
+
+
+def build(games=100, depth=3, explore=0.3, seed=0, book=None):
+    """Search every setup position of that many games and book the moves found. Each ply plays the searched move,
+    or with probability explore a random empty cell, so the book covers more than one line"""
+    book = book if book is not None else OpeningBook()
+    rng = random.Random(seed)
+    names = ['Matt', 'F. Rob', 'Rob H.']
+    suits = [chr(9829), chr(9830), chr(9827)]
+    for _ in range(games):
+        players = [curling2.AITreeSearch(n, s) for n, s in zip(names, suits)]
+        for p in players:
+            p.depth = depth
+        game = curling2.Game(curling2.StartGameState(curling2.Board(), players), autostart=False, verbose=False)
+        while game.board._empty:
+            player = game.players[game.p_turn]
+            ply = player.make_move(game.get_game_state())
+            book.add(game, ply)
+            if rng.random() < explore:
+                row, column = rng.choice(game.board.get_empty())
+                ply = curling2.Ply(player.in_hand(rng.choice(player.hand)), row, column)
+            game.make_move(ply)
+    return book
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    fname = args[2] if len(args) > 2 else 'openings.json'
+    try:
+        book = OpeningBook.load(fname)
+    except FileNotFoundError:
+        book = OpeningBook()
+    build(int(args[0]) if args else 100, int(args[1]) if len(args) > 1 else 3, book=book)
+    book.save(fname)
+    print(len(book.moves), 'positions in', fname)
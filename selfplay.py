@@ -0,0 +1,84 @@
+import concurrent.futures
+import os
+import random
+
+
+class Results:
+    """Running totals over finished games, so nothing grows with the number of games"""
+    def __init__(self, n_players=3):
+        self.games = 0
+        self.wins = [0] * n_players  # joint winners all count
+        self.totals = [0] * n_players
+        self.margins = [0] * n_players  # player i's score minus the next player's
+        self.winning_total = 0
+
+    def add(self, scores):
+        self.games += 1
+        top = max(scores)
+        for i, score in enumerate(scores):
+            if score == top:
+                self.wins[i] += 1
+            self.totals[i] += score
+            self.margins[i] += score - scores[(i + 1) % len(scores)]
+        self.winning_total += top
+
+    def summary(self):
+        n = max(self.games, 1)
+        return {'games': self.games,
+                'wins': list(self.wins),
+                'mean_scores': [t / n for t in self.totals],
+                'margins': [m / n for m in self.margins],
+                'mean_winning_score': self.winning_total / n}
+
+    def report(self):
+        summary = self.summary()
+        print("Wins", summary['wins'])
+        print("Av score")
+        for score in summary['mean_scores']:
+            print(score)
+        print("Margins:", summary['margins'])
+        print("Av winning score:", summary['mean_winning_score'])
+        print()
+
+
+def game_seed(seed, i):
+    # Each game gets its own seed, so a run gives the same games however they are split between processes
+    return '{}-{}'.format(seed, i)
+
+
+def _play_chunk(game, seed, start, stop):
+    out = []
+    for i in range(start, stop):
+        random.seed(game_seed(seed, i))
+        out.append(game())
+    return out
+
+
+def play_games(game, runs, workers=None, seed=None, chunk=50, n_players=3):
+    """Play runs games by calling game(), which returns the list of final scores, and total them up.
+    game has to be picklable (a module level function or a functools.partial of one) to go to the worker processes.
+    With workers=1 everything runs in this process. Pass a seed to repeat a run exactly"""
+    results = Results(n_players)
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1:
+        for scores in _play_chunk(game, seed, 0, runs):
+            results.add(scores)
+        return results
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        pending = set()
+        for start in range(0, runs, chunk):
+            # keep a couple of chunks queued per worker and total the rest as they come back
+            if len(pending) >= 2 * workers:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    for scores in future.result():
+                        results.add(scores)
+            pending.add(pool.submit(_play_chunk, game, seed, start, min(start + chunk, runs)))
+        for future in concurrent.futures.as_completed(pending):
+            for scores in future.result():
+                results.add(scores)
+    return results
@@ -0,0 +1,257 @@
+"""Hosts many curling.py games at once for a front end, on asyncio.
+
+Games live in the service's own curling.SessionStore under one file per game id. Each game has a lock so its turns
+happen one at a time, every change is pushed to the game's subscribers as a state dict, and AI turns run in an
+executor so the event loop keeps serving other games. Disk access stays off the loop too: games are read in a thread
+when they aren't cached, and a background task writes the changed ones every flush_interval seconds from pickled
+copies. Players with gm 'tree' are played by curling2's AITreeSearch; pass a ProcessPoolExecutor if there are many of
+them. LocalClient drives a game from the same process."""
+import asyncio
+import atexit
+import collections
+import copy
+import os
+import random
+
+import curling
+import curling2
+
+
+def state(data):
+    board, players, discarded, p_turn, statement = data
+    return {'board': str(board),
+            'scores': '\n'.join('{}: {}'.format(player, player.score) for player in players),
+            'statement': statement,
+            'p_turn': p_turn,
+            'final': bool(board.final)}
+
+
+def tree_turn(data, depth=2):
+    # AITreeSearch plays curling2 games, so the position is copied across and the ply it picks is played here
+    board, players, discarded, p_turn, statement = data
+    board2 = curling2.Board(board.size, empty=[])
+    board2.set_cells([c.id if c else 0 for row in board.cards for c in row])
+    players2 = []
+    for player in players:
+        player2 = curling2.Player(player.name, player.suit)
+        player2.score = player.score
+        player2.hand = player.hand
+        players2.append(player2)
+    ai = curling2.AITreeSearch(players[p_turn].name, players[p_turn].suit)
+    ai.depth = depth
+    ply = ai.make_move(curling2.GameState(board2, players2, [], p_turn, False))
+    if curling.turn(ply.card.name, ply.row, ply.column, save=0, data=data) != 'Done':
+        raise Exception('ai error')
+
+
+def write_all(writes):
+    for fname, data in writes:
+        curling.write(fname, data)
+
+
+def ai_turn(data):
+    """Play the AI whose turn it is on a copy of the game, and return the copy. Run in the service's executor"""
+    data = copy.deepcopy(data)
+    board, players, discarded, p_turn, statement = data
+    player = players[p_turn]
+    if player.gm == 'tree':
+        tree_turn(data)
+    elif 'r' in player.gm:
+        curling.random_ai_turn(player, board, players, discarded, p_turn, statement, save=0, data=data)
+    else:
+        curling.one_set_ai(player, board, players, discarded, p_turn, statement, save=0, data=data)
+    return data
+
+
+class GameService:
+    def __init__(self, directory='.', capacity=4096, executor=None, queue_size=16, flush_interval=5.0):
+        self.directory = directory
+        self.executor = executor  # None for the event loop's default thread pool
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self._locks = collections.defaultdict(asyncio.Lock)
+        self._subscribers = collections.defaultdict(set)
+        self._flusher = None
+        self._flush_lock = asyncio.Lock()  # one batch of writes at a time, so a game's writes land in order
+        # games are written by flush, and at exit whatever shutdown didn't get to
+        self.sessions = curling.SessionStore(capacity, flush_interval=None)
+        atexit.register(self.sessions.flush)
+
+    async def _load(self, game_id):
+        # the game's data, read in a thread if it isn't in memory
+        fname = self.fname(game_id)
+        self._start()
+        if not self.sessions.cached(fname):
+            data = await asyncio.get_running_loop().run_in_executor(None, curling.load, fname)
+            if not self.sessions.cached(fname):
+                self.sessions.add(fname, data)
+        return self.sessions.get(fname)
+
+    def _start(self):
+        # the flush task needs a running loop, so it starts with the first call
+        if self._flusher is None:
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """Write every changed game, pickled on the loop and written in a thread"""
+        async with self._flush_lock:
+            writes = self.sessions.take_writes()
+            if not writes:
+                return
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, write_all, writes)
+            except BaseException:
+                self.sessions.written(writes, False)
+                raise
+            self.sessions.written(writes)
+
+    async def shutdown(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+    def fname(self, game_id):
+        return os.path.join(self.directory, '{}.pi'.format(game_id))
+
+    def subscribe(self, game_id):
+        """A queue that gets the game's state after every change"""
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers[game_id].add(queue)
+        return queue
+
+    def unsubscribe(self, game_id, queue):
+        self._subscribers[game_id].discard(queue)
+        if not self._subscribers[game_id]:
+            del self._subscribers[game_id]
+
+    def publish(self, game_id):
+        if game_id not in self._subscribers:
+            return
+        update = state(self.sessions.get(self.fname(game_id)))
+        for queue in self._subscribers[game_id]:
+            # every update is the whole state, so a slow client only needs the latest ones
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(update)
+
+    async def create(self, game_id, ai=(0, 0, 0), gm=('', '', '')):
+        async with self._locks[game_id]:
+            fname = self.fname(game_id)
+            self._start()
+            data = curling.setup(fname, save=0)
+            for player, a, g in zip(data[1], ai, gm):
+                player.ai = a
+                player.gm = g
+            self.sessions.put(fname, data)
+            self.publish(game_id)
+            await self._advance(game_id)
+            return state(self.sessions.get(fname))
+
+    async def information(self, game_id):
+        # Reads don't take the lock: every change to a game happens in one step on the event loop
+        return state(await self._load(game_id))
+
+    async def turn(self, game_id, card, row, column):
+        async with self._locks[game_id]:
+            data = await self._load(game_id)
+            if data[0].final:
+                return 'Game over'
+            if data[1][data[3]].ai:
+                return 'Not your turn'
+            message = curling.turn(card, row, column, save=0, data=data)
+            if message == 'Done':
+                self.sessions.changed(self.fname(game_id))
+                self.publish(game_id)
+                await self._advance(game_id)
+            return message
+
+    async def set_ai(self, game_id, player_n, ai_on, gm=None):
+        async with self._locks[game_id]:
+            player = (await self._load(game_id))[1][player_n]
+            player.ai = ai_on
+            if gm is not None:
+                player.gm = gm
+            self.sessions.changed(self.fname(game_id))
+            self.publish(game_id)
+            await self._advance(game_id)
+
+    async def _advance(self, game_id):
+        # Play AI turns until a person's turn or the end of the game. The caller holds the game's lock
+        fname = self.fname(game_id)
+        loop = asyncio.get_running_loop()
+        while True:
+            data = self.sessions.get(fname)
+            if data[0].final:
+                return
+            if not any(p.hand for p in data[1]):
+                curling.final(data=data, save=0)
+                self.sessions.changed(fname)
+                self.publish(game_id)
+                return
+            if not data[1][data[3]].ai:
+                return
+            self.sessions.put(fname, await loop.run_in_executor(self.executor, ai_turn, data))
+            self.publish(game_id)
+
+    async def close(self, game_id):
+        """Write the game out and stop tracking it"""
+        self._locks.pop(game_id, None)
+        self._subscribers.pop(game_id, None)
+        await self.flush()
+
+
+class LocalClient:
+    """A client of a GameService in the same process"""
+    def __init__(self, service, game_id):
+        self.service = service
+        self.game_id = game_id
+        self.updates = service.subscribe(game_id)
+
+    async def information(self):
+        return await self.service.information(self.game_id)
+
+    async def turn(self, card, row, column):
+        return await self.service.turn(self.game_id, card, row, column)
+
+    async def next_update(self, timeout=None):
+        return await asyncio.wait_for(self.updates.get(), timeout)
+
+    def close(self):
+        self.service.unsubscribe(self.game_id, self.updates)
+
+
+async def play_locally(service, game_id, gm=('', '', '')):
+    # One person (player 0, playing their highest card anywhere it fits) against two AIs
+    await service.create(game_id, (0, 1, 1), gm)
+    client = LocalClient(service, game_id)
+    try:
+        while True:
+            info = await client.information()
+            if info['final']:
+                return info
+            data = service.sessions.get(service.fname(game_id))
+            card = max(data[1][0].hand, key=lambda c: c.value).name
+            empty = data[0].get_empty()
+            row, column = random.choice(empty) if empty else (0, random.randint(1, data[0].size))
+            await client.turn(card, row, column)
+    finally:
+        client.close()
+        await service.close(game_id)
+
+
+async def demo(games=200, directory='.'):
+    service = GameService(directory)
+    results = await asyncio.gather(*(play_locally(service, 'demo{}'.format(i)) for i in range(games)))
+    await service.shutdown()
+    print(results[0]['statement'])
+    print(len(results), 'games finished')
+
+
+if __name__ == '__main__':
+    asyncio.run(demo())
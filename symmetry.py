@@ -0,0 +1,69 @@
+"""The 8 rotations and reflections of the board.
+
+Each one maps the board to itself. The joker stays in the centre, and the default empty cells and the scoring cells
+map to themselves, so the game can't tell two symmetric positions apart. They act on (row, column) over the board
+and the edges around it (0 to size + 1), so a cell maps to a cell and an edge move to the edge move that pushes the
+matching line the matching way. Transform 0 is the identity.
+
+Canonical positions let the search's transposition table and the opening book share entries between symmetric
+positions. canonical_* return the transform taking the position to its canonical form as well as the form, so moves
+can be mapped there with move() and back with the inverse."""
+
+
+def _transforms(m):
+    return [lambda r, c: (r, c), lambda r, c: (c, m - r), lambda r, c: (m - r, m - c), lambda r, c: (m - c, r),
+            lambda r, c: (r, m - c), lambda r, c: (c, r), lambda r, c: (m - r, c), lambda r, c: (m - c, m - r)]
+
+
+class Symmetries:
+    def __init__(self, size):
+        self.size = size
+        grid = [(r, c) for r in range(size + 2) for c in range(size + 2)]
+        # (row, column) -> (row, column) for each transform
+        self.maps = [{p: f(*p) for p in grid} for f in _transforms(size + 1)]
+        self.inverse = [next(u for u, back in enumerate(self.maps) if all(back[m[p]] == p for p in grid))
+                        for m in self.maps]
+        # flat cell index -> flat cell index
+        self.cells = [tuple((m[r, c][0] - 1) * size + m[r, c][1] - 1
+                            for r in range(1, size + 1) for c in range(1, size + 1)) for m in self.maps]
+
+    def move(self, t, row, column):
+        return self.maps[t][row, column]
+
+    def transform_cells(self, t, cells):
+        out = [0] * len(cells)
+        for i, j in enumerate(self.cells[t]):
+            out[j] = cells[i]
+        return out
+
+
+_symmetries = {}
+
+
+def symmetries(size):
+    if size not in _symmetries:
+        _symmetries[size] = Symmetries(size)
+    return _symmetries[size]
+
+
+def canonical_cells(cells, size, code=None):
+    """(t, cells) for the transform whose cells, as codes if code is given, are smallest"""
+    sym = symmetries(size)
+    if code is not None:
+        cells = [code(c) for c in cells]
+    return min((sym.transform_cells(t, cells), t) for t in range(8))[::-1]
+
+
+def canonical_hash(board):
+    """(t, hash) for the transform whose Zobrist hash of the cells is smallest"""
+    sym = symmetries(board.size)
+    zobrist = board._zobrist
+    cells = board._cells
+    best = None
+    for t, perm in enumerate(sym.cells):
+        h = 0
+        for i, j in enumerate(perm):
+            h ^= zobrist[j][cells[i]]
+        if best is None or h < best[1]:
+            best = (t, h)
+    return best
@@ -0,0 +1,87 @@
+"""The binary save format and the journal save mode of curling2.Game.
+
+A journaled game is played in a child process that exits without closing anything, as a crash would, and is then
+loaded here and compared with the same game played without saving."""
+import os
+import random
+import subprocess
+import sys
+
+import curling2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+JOURNAL = 4  # plies between snapshots
+
+
+def new_game(fname='', journal=0, load=0):
+    players = [curling2.AIPlayer(n, chr(s)) for n, s in (('Matt', 9829), ('F. Rob', 9830), ('Rob H.', 9827))]
+    return curling2.Game(curling2.StartGameState(curling2.Board(), players), fname=fname, save=bool(fname),
+                         load=load, autostart=False, journal=journal, verbose=False)
+
+
+def play(plies, seed=3, fname='', journal=0):
+    random.seed(seed)
+    game = new_game(fname, journal)
+    for _ in range(plies):
+        game.turn()
+    return game
+
+
+def position(game):
+    # of a Game or a GameState
+    return (str(game.board), [p.score for p in game.players], [[c.name for c in p.hand] for p in game.players],
+            game.p_turn, game.gameover, [(repr(ply), repr(discard)) for ply, discard in game.plyhistory])
+
+
+def crash(fname, plies):
+    # play a journaled game in a child process, which exits straight after the last ply
+    code = 'import os, test_journal; test_journal.play({}, fname={!r}, journal={}); os._exit(0)'.format(
+        plies, fname, JOURNAL)
+    subprocess.run([sys.executable, '-c', code], cwd=HERE, check=True)
+
+
+def test_save_format_round_trip():
+    for plies in (0, 5, 20, 39):
+        game = play(plies)
+        loaded = curling2.unpack_game(curling2.pack_game(game.get_game_state(), 7), new_game().players)
+        assert position(loaded) == position(game)
+        assert curling2.Game(loaded, autostart=False, verbose=False).hash == game.hash
+        assert curling2.save_seq(curling2.pack_game(game.get_game_state(), 7)) == 7
+    assert game.gameover and loaded.board._final
+
+
+def test_journal_recovers_after_a_crash(tmp_path):
+    fname = str(tmp_path / 'game.crl')
+    for plies in (3, JOURNAL, 10, 39):
+        crash(fname, plies)
+        recovered = new_game(fname, JOURNAL, load=1)
+        game = play(plies)
+        assert position(recovered) == position(game)
+        assert recovered.hash == game.hash
+        recovered.close()
+
+
+def test_journal_drops_a_torn_last_record(tmp_path):
+    # records are 8 bytes, and after 10 plies the log holds the 2 since the last snapshot
+    fname = str(tmp_path / 'game.crl')
+    for torn in (1, 3, 7):
+        crash(fname, 10)
+        with open(fname + '.log', 'rb+') as f:
+            f.truncate(os.path.getsize(fname + '.log') - torn)
+        recovered = new_game(fname, JOURNAL, load=1)
+        assert position(recovered) == position(play(9))
+        recovered.close()
+
+
+def test_journal_skips_records_the_snapshot_has(tmp_path):
+    # a crash after the snapshot at ply 8 is swapped in but before the log of plies 5 to 7 is emptied
+    fname = str(tmp_path / 'game.crl')
+    crash(fname, 7)
+    with open(fname + '.log', 'rb') as f:
+        stale = f.read()
+    crash(fname, 8)
+    with open(fname + '.log', 'wb') as f:
+        f.write(stale)
+    recovered = new_game(fname, JOURNAL, load=1)
+    assert position(recovered) == position(play(8))
+    recovered.close()
@@ -0,0 +1,68 @@
+"""Saves written by older versions still load and play on.
+
+testdata/curling_baseline.pi is a curling.py game 15 turns in, pickled by the original curling.py, from before cards
+were interned and the board kept its scoring tables. testdata/curling2_baseline.pi is a curling2 game 16 plies in, a
+pickled GameState from before the binary save format."""
+import os
+import shutil
+
+import curling
+import curling2
+from cards import Card, Joker
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_curling_baseline_save_plays_a_turn():
+    data = list(curling.load(os.path.join(HERE, 'testdata', 'curling_baseline.pi')))
+    board, players = data[:2]
+    assert board.joker is Joker()
+    assert [p.score for p in players] == [0, 0, 10]
+    assert [board.score(p.suit) for p in players] == [0, 0, 10]
+    assert players[0].in_hand('3') is Card('3', players[0].suit)
+    scores = board.test_moves(Card('3', players[0].suit), [(0, 2)], [p.suit for p in players])
+
+    # what the original curling.py made of the same turn
+    assert curling.turn('3', 0, 2, save=0, data=data) == 'Done'
+    board, players, discarded, p_turn, statement = data
+    assert [board.score(p.suit) for p in players] == [0, 10, 10]
+    assert scores == [[0, 10, 10]]
+    assert [p.score for p in players] == [0, 10, 10]
+    assert p_turn == 1
+    assert [str(c) for c in discarded] == ['* *', 'A {}'.format(chr(9830)), 'A {}'.format(chr(9827)),
+                                           'A {}'.format(chr(9829))]
+    assert str(board).splitlines()[:2] == [
+        'K {0} | 3 {0} | 2 {0} | 2 {1} | 2 {2}'.format(chr(9829), chr(9830), chr(9827)),
+        'Q {1} | K {1} | * * | K {2} | Q {0}'.format(chr(9829), chr(9830), chr(9827))]
+
+
+def test_curling_upgraded_save_round_trips(tmp_path):
+    data = curling.load(os.path.join(HERE, 'testdata', 'curling_baseline.pi'))
+    fname = str(tmp_path / 'game.pi')
+    curling.dump(*data, fname)
+    board, players, discarded, p_turn, statement = curling.load(fname)
+    assert str(board) == str(data[0])
+    assert [p.hand for p in players] == [p.hand for p in data[1]]
+    assert [p.mask for p in players] == [p.mask for p in data[1]]
+    assert discarded == data[2] and p_turn == data[3] and statement == data[4]
+
+
+def test_curling2_baseline_save_plays_and_is_saved_again(tmp_path):
+    fname = str(tmp_path / 'game.pi')
+    shutil.copy(os.path.join(HERE, 'testdata', 'curling2_baseline.pi'), fname)
+    players = [curling2.Player(n, chr(s)) for n, s in (('Matt', 9829), ('F. Rob', 9830), ('Rob H.', 9827))]
+    game = curling2.Game(curling2.StartGameState(curling2.Board(), players), fname=fname, autostart=False,
+                         verbose=False)
+    with open(fname, 'rb') as f:
+        assert f.read().startswith(curling2.SAVE_MAGIC)
+    assert [p.score for p in players] == [10, 89, 0]
+    assert [len(p.hand) for p in players] == [2, 2, 2]
+    assert game.p_turn == 0 and not game.gameover
+
+    # what the original curling2 made of the same move
+    assert game.make_move(curling2.Ply(players[0].hand[0], 0, 2)) == 'Done'
+    assert [p.score for p in players] == [10, 125, 0]
+    assert game.p_turn == 1
+    assert str(game.board).splitlines()[:2] == ['6 {0} | A {0} | A {1} | * * | 3 {0}'.format(chr(9829), chr(9830)),
+                                                'Q {0} | K {0} | 9 {0} | * * | * *'.format(chr(9830))]
+    assert str(game.load().board) == str(game.board)